@@ -0,0 +1,193 @@
+from python_parsers import get_func_calls, to_remove, get_all_calls, get_indent_from_file, remove_docstring, same_ast_with_reason, replace_func
+from get_code_docs import CodeData
+
+import argparse
+from argparse import RawTextHelpFormatter
+import tracemalloc
+import tempfile
+import logging
+import timeit
+import json
+import ast
+import os
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+)
+
+
+def generate_function(name, num_calls, num_lines, indent='    ', level=0):
+    prefix = indent * level
+    lines = [f'{prefix}def {name}(a, b):']
+    lines += [f'{prefix}{indent}x{i} = helper_{i % num_calls}(a, b) + obj.method_{i % num_calls}(x{i-1 if i else 0})' for i in range(num_lines)]
+    lines += [f'{prefix}{indent}return x{num_lines-1 if num_lines else 0}']
+    return '\n'.join(lines)
+
+
+def generate_class(name, num_methods, depth, num_calls, num_lines, indent='    ', level=0):
+    prefix = indent * level
+    lines = [f'{prefix}class {name}:']
+    if depth > 1:
+        lines.append(generate_class(f'{name}_inner', num_methods, depth-1, num_calls, num_lines, indent, level+1))
+    for i in range(num_methods):
+        lines.append(generate_function(f'{name}_method_{i}', num_calls, num_lines, indent, level+1))
+    return '\n\n'.join(lines)
+
+
+def generate_module(num_funcs, num_classes, num_methods, depth, num_calls, num_lines):
+    blocks = ['import os', 'import numpy as np']
+    blocks += [generate_function(f'func_{i}', num_calls, num_lines) for i in range(num_funcs)]
+    blocks += [generate_class(f'Class_{i}', num_methods, depth, num_calls, num_lines) for i in range(num_classes)]
+    return '\n\n\n'.join(blocks) + '\n'
+
+
+def get_benchmarks(scale, tmp_dir):
+    module_str = generate_module(num_funcs=20*scale, num_classes=2*scale, num_methods=10, depth=3, num_calls=20, num_lines=10)
+    module_path = os.path.join(tmp_dir, 'synthetic_module.py')
+    with open(module_path, 'w') as f:
+        f.write(module_str)
+
+    big_func_str = generate_function('big_func', num_calls=250*scale, num_lines=1000*scale)
+    big_func_node = ast.parse(big_func_str).body[0]
+    call_names = [f'obj_{i}.method_{i}' for i in range(1000*scale)] + ['len', 'x.append', 'print']
+
+    documented_node = ast.parse(big_func_str.replace('(a, b):', '(a, b):\n    """Docstring."""', 1)).body[0]
+
+    code_dependancies = CodeData()
+    get_all_calls(module_path, module_str, code_dependancies)
+    func_names = list(code_dependancies.keys())
+
+    last_func_str = ast.get_source_segment(module_str, ast.parse(module_str).body[-1].body[-1])
+
+    def code_data_ops():
+        cd = CodeData()
+        for i, func_name in enumerate(func_names):
+            cd.add(func_name, {CodeData.DEP: func_names[max(0, i-20):i], CodeData.CUSTOM: True})
+        for func_name in func_names:
+            cd.undocumented_dependancies(func_name)
+
+    return {
+        'get_func_calls': lambda: get_func_calls(big_func_node),
+        'to_remove': lambda: [to_remove(call) for call in call_names],
+        'get_all_calls': lambda: get_all_calls(module_path, module_str, CodeData()),
+        'get_indent_from_file': lambda: get_indent_from_file(module_path),
+        'remove_docstring+same_ast_with_reason': lambda: same_ast_with_reason(remove_docstring(big_func_node), remove_docstring(documented_node)),
+        'replace_func': lambda: replace_func('last', last_func_str, last_func_str, module_path, module_str),
+        'code_data_ops': code_data_ops,
+    }
+
+
+def run_benchmarks(scale, repeat, number, names=None):
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, bench in get_benchmarks(scale, tmp_dir).items():
+            if names and name not in names:
+                continue
+
+            times = timeit.repeat(bench, repeat=repeat, number=number)
+
+            tracemalloc.start()
+            bench()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results[name] = {'time': min(times) / number, 'peak_memory': peak}
+            logging.info(f'{name:<40} time: {1000*results[name]["time"]:>10.3f} ms  peak memory: {peak/1024:>10.1f} KiB')
+
+    return results
+
+
+def compare_results(baseline, results, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            logging.info(f'{name:<40} no baseline')
+            continue
+
+        for metric in ['time', 'peak_memory']:
+            change = result[metric] / baseline[name][metric] - 1 if baseline[name][metric] else 0
+            status = 'REGRESSION' if change > threshold else 'ok'
+            logging.info(f'{name:<40} {metric:<12} {change:>+8.1%} {status}')
+            if change > threshold:
+                regressions.append((name, metric, change))
+
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description='Micro-benchmarks for the parsing, verification and rewrite code of lmdocs')
+
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=1,
+        help="Multiplier for the size of the synthetic code"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of timing runs, the fastest one is reported"
+    )
+
+    parser.add_argument(
+        "--number",
+        type=int,
+        default=1,
+        help="Number of calls per timing run"
+    )
+
+    parser.add_argument(
+        "--only",
+        nargs='+',
+        help="Only run the given benchmarks"
+    )
+
+    parser.add_argument(
+        "--save",
+        help="Save the results as a baseline to the given JSON file"
+    )
+
+    parser.add_argument(
+        "--compare",
+        help="Compare the results with the baseline in the given JSON file"
+    )
+
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown or memory increase reported as a regression with --compare. Defaults to 0.2 (20%%)"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+
+    results = run_benchmarks(args.scale, args.repeat, args.number, args.only)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'scale': args.scale, 'results': results}, f, indent=2)
+        logging.info(f'Saved baseline in {args.save}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['scale'] != args.scale:
+            logging.warning(f'Baseline was recorded with --scale {baseline["scale"]}, comparing against --scale {args.scale}')
+
+        regressions = compare_results(baseline['results'], results, args.threshold)
+        if regressions:
+            logging.error(f'{len(regressions)} regression(s) above {args.threshold:.0%}: ' + ', '.join(f'{name} ({metric} {change:+.1%})' for name, metric, change in regressions))
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,20 @@ CALLS_TO_INGORE = {
 }
 
 MAX_TOKENS = 2048
+MIN_MAX_TOKENS = 128
+CHARS_PER_TOKEN = 4
+REF_DOC_TOKENS = 30
+DOC_TOKENS = 150
+PATCH_COMMENT_RATIO = 0.25
+CODE = 'code'
+PATCH = 'patch'
+DOCUMENTED = 'documented'
+TRIVIAL = 'trivial'
+NEEDS_LLM = 'llm'
+OTHER_SHARD = 'other_shard'
+TRUNCATED_CALLS = 'truncated_calls'
+HEALTH_CHECK_TIMEOUT = 5
+DEFAULT_CALL_LATENCY = 10.0
 TEMPERATURE = 0.8
 STOP_TOKENS=['<|EOT|>', '<STOP>']
 LOCAL = 'local'
@@ -0,0 +1,339 @@
+from python_parsers import get_all_call_names, get_output_mode
+from get_code_docs import CodeData
+from prompts import SYSTEM_PROMPT, DOC_GENERATION_PROMPT, DOC_PATCH_PROMPT
+from constants import CHARS_PER_TOKEN, REF_DOC_TOKENS, PATCH
+from llm_inference import count_tokens, estimate_completion_tokens
+
+import logging
+import heapq
+import ast
+import json
+import math
+import os
+
+
+def get_symbol_index(path, parser=get_all_call_names):
+    symbol_index = {}
+
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                if os.path.splitext(file)[-1] == '.py':
+                    file_path = os.path.join(root, file)
+                    with open(file_path) as f:
+                        symbol_index[file_path] = parser(f.read())
+
+    elif os.path.splitext(path)[-1] == '.py':
+        with open(path) as f:
+            symbol_index[path] = parser(f.read())
+
+    else:
+        raise Exception(f'Could not parse path: `{path}`')
+
+    return symbol_index
+
+
+def get_code_tokens(code_str):
+    code_tokens = {}
+    code_lines = code_str.split('\n')
+
+    nodes = []
+    for node in ast.parse(code_str).body:
+        if isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef):
+            if isinstance(node, ast.ClassDef):
+                nodes.extend(child_node for child_node in node.body if isinstance(child_node, ast.FunctionDef))
+            nodes.append(node)
+
+    for node in nodes:
+        tokens = count_tokens('\n'.join(code_lines[node.lineno-1:node.end_lineno]))
+        code_tokens[node.name] = max(code_tokens.get(node.name, 0), tokens)
+
+    return code_tokens
+
+
+def get_symbol_weights(path):
+    # Duplicated names (e.g. `__init__`) weigh as their largest definition, whichever copy was parsed last
+    weights = {}
+    for code_tokens in get_symbol_index(path, get_code_tokens).values():
+        for func_name, tokens in code_tokens.items():
+            weights[func_name] = max(weights.get(func_name, 0), tokens + 1)
+    return weights
+
+
+def strongly_connected_components(graph):
+    # Iterative Tarjan, components are returned dependencies first
+    index, lowlink, on_stack = {}, {}, set()
+    stack, components = [], []
+
+    for start in sorted(graph):
+        if start in index:
+            continue
+
+        work = [(start, iter(sorted(graph.get(start, ()))))]
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in graph:
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(graph.get(child, ())))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+
+    return components
+
+
+def get_package_graph(symbol_index):
+    defined_in = {}
+    for path, calls in symbol_index.items():
+        for func_name in calls:
+            defined_in.setdefault(func_name, set()).add(path)
+
+    package_graph = {}
+    for path, calls in symbol_index.items():
+        package = os.path.dirname(path)
+        package_deps = package_graph.setdefault(package, set())
+        for deps in calls.values():
+            for dep_func in deps:
+                package_deps.update(os.path.dirname(dep_path) for dep_path in defined_in.get(dep_func, ()))
+        package_deps.discard(package)
+
+    return package_graph
+
+
+def get_partitions(symbol_index, partition_size):
+    package_files = {}
+    for path in sorted(symbol_index):
+        package_files.setdefault(os.path.dirname(path), []).append(path)
+
+    partitions, cur_partition = [], []
+    for component in strongly_connected_components(get_package_graph(symbol_index)):
+        files = [path for package in component for path in package_files[package]]
+
+        if len(files) > partition_size:
+            logging.warning(f'Packages {component} depend on each other, keeping their {len(files)} files in a single partition')
+
+        if cur_partition and len(cur_partition) + len(files) > partition_size:
+            partitions.append(cur_partition)
+            cur_partition = []
+        cur_partition.extend(files)
+
+    if cur_partition:
+        partitions.append(cur_partition)
+
+    return partitions
+
+
+def get_symbol_graph(code_dependancies):
+    custom_funcs = set(func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM])
+    return {
+        func_name: sorted(set(dep for dep in code_dependancies[func_name][CodeData.DEP] if dep in custom_funcs and dep != func_name))
+        for func_name in custom_funcs
+    }
+
+
+def estimate_tokens(code_dependancies, func_name, output_mode):
+    func_info = code_dependancies[func_name]
+    output_mode = get_output_mode(func_info[CodeData.NODE], output_mode)
+    ref_docs = [
+        {'function': dep, 'doc_str': code_dependancies[dep][CodeData.DOC_SHORT] if code_dependancies[dep][CodeData.DOC_SHORT] != '-' else ' ' * CHARS_PER_TOKEN * REF_DOC_TOKENS}
+        for dep in func_info[CodeData.DEP]
+    ]
+    prompt = DOC_PATCH_PROMPT if output_mode == PATCH else DOC_GENERATION_PROMPT
+    prompt_tokens = count_tokens(SYSTEM_PROMPT + prompt(func_info[CodeData.CODE], ref_docs))
+    completion_tokens = estimate_completion_tokens(func_info[CodeData.CODE], output_mode)
+    return prompt_tokens, completion_tokens
+
+
+def predict_wall_time(component_graph, component_sizes, call_latency, concurrency):
+    # List scheduling of components (members of a cycle are documented one after the other),
+    # starting the component with the longest remaining path first
+    dependants = {component: [] for component in component_graph}
+    for component, deps in component_graph.items():
+        for dep in deps:
+            dependants[dep].append(component)
+
+    remaining = {}
+    for component in reversed(list(component_graph)):
+        remaining[component] = component_sizes[component] * call_latency + max([remaining[dep] for dep in dependants[component]], default=0)
+
+    pending = {component: len(deps) for component, deps in component_graph.items()}
+    ready = [(-remaining[component], component) for component, n in pending.items() if n == 0]
+    heapq.heapify(ready)
+    running, now = [], 0.0
+
+    while ready or running:
+        while ready and len(running) < concurrency:
+            _, component = heapq.heappop(ready)
+            heapq.heappush(running, (now + component_sizes[component] * call_latency, component))
+
+        now, component = heapq.heappop(running)
+        for dependant in dependants[component]:
+            pending[dependant] -= 1
+            if pending[dependant] == 0:
+                heapq.heappush(ready, (-remaining[dependant], dependant))
+
+    return now
+
+
+def analyze_graph(code_dependancies, call_latency, concurrency_levels, output_mode):
+    symbol_graph = get_symbol_graph(code_dependancies)
+    components = strongly_connected_components(symbol_graph)
+
+    component_of = {func_name: ci for ci, component in enumerate(components) for func_name in component}
+    component_graph = {
+        ci: sorted(set(component_of[dep] for func_name in component for dep in symbol_graph[func_name]) - {ci})
+        for ci, component in enumerate(components)
+    }
+    component_sizes = {ci: len(component) for ci, component in enumerate(components)}
+
+    # Components are ordered dependencies first, so levels and critical paths can be computed in one pass
+    levels, path_len, path_prev = {}, {}, {}
+    for ci in component_graph:
+        deps = component_graph[ci]
+        levels[ci] = 1 + max([levels[dep] for dep in deps], default=0)
+        best_dep = max(deps, key=lambda dep: path_len[dep], default=None)
+        path_len[ci] = component_sizes[ci] + (path_len[best_dep] if best_dep is not None else 0)
+        path_prev[ci] = best_dep
+
+    critical_path = []
+    ci = max(path_len, key=lambda x: path_len[x], default=None)
+    while ci is not None:
+        critical_path = components[ci] + critical_path
+        ci = path_prev[ci]
+
+    fan_in = {func_name: 0 for func_name in code_dependancies.keys()}
+    for func_name, func_info in code_dependancies.items():
+        if func_info[CodeData.CUSTOM]:
+            for dep in set(func_info[CodeData.DEP]):
+                fan_in[dep] = fan_in.get(dep, 0) + 1
+
+    symbols = {}
+    for func_name in sorted(symbol_graph):
+        prompt_tokens, completion_tokens = estimate_tokens(code_dependancies, func_name, output_mode)
+        symbols[func_name] = {
+            'path': code_dependancies[func_name][CodeData.PATH],
+            'type': code_dependancies[func_name][CodeData.TYPE],
+            'dependancies': code_dependancies[func_name][CodeData.DEP],
+            'fan_in': fan_in[func_name],
+            'level': levels[component_of[func_name]],
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+        }
+
+    return {
+        'symbols': symbols,
+        'num_levels': max(levels.values(), default=0),
+        'critical_path': critical_path,
+        'cycles': [component for component in components if len(component) > 1],
+        'fan_in_hotspots': sorted([(func_name, n) for func_name, n in fan_in.items() if n > 1], key=lambda x: (-x[1], x[0]))[:10],
+        'prompt_tokens': sum(info['prompt_tokens'] for info in symbols.values()),
+        'completion_tokens': sum(info['completion_tokens'] for info in symbols.values()),
+        'call_latency': call_latency,
+        'wall_time': {
+            concurrency: round(predict_wall_time(component_graph, component_sizes, call_latency, concurrency), 1)
+            for concurrency in concurrency_levels
+        },
+    }
+
+
+def export_graph(code_dependancies, analysis, fmt, output_path):
+    if fmt == 'json':
+        with open(output_path, 'w') as f:
+            json.dump(analysis, f, indent=2)
+
+    elif fmt == 'dot':
+        critical_path = set(analysis['critical_path'])
+        with open(output_path, 'w') as f:
+            f.write('digraph lmdocs {\n')
+            for func_name, func_info in code_dependancies.items():
+                attrs = {'label': func_name, 'shape': 'box' if func_info[CodeData.CUSTOM] else 'ellipse'}
+                if func_name in critical_path:
+                    attrs['color'] = 'red'
+                f.write(f'  {json.dumps(func_name)} [' + ', '.join(f'{k}={json.dumps(v)}' for k,v in attrs.items()) + '];\n')
+            for func_name, func_info in code_dependancies.items():
+                for dep in sorted(set(func_info[CodeData.DEP])):
+                    f.write(f'  {json.dumps(func_name)} -> {json.dumps(dep)};\n')
+            f.write('}\n')
+
+    else:
+        raise Exception(f'Unknown graph format: `{fmt}`')
+
+
+def log_graph_analysis(analysis):
+    logging.info(f'Custom functions/methods/classes: {len(analysis["symbols"])}')
+    logging.info(f'Topological levels: {analysis["num_levels"]}')
+    logging.info(f'Critical path length: {len(analysis["critical_path"])} calls ({" -> ".join(analysis["critical_path"])})')
+    logging.info(f'Cycle groups: {len(analysis["cycles"])}' + ''.join(f'\n\t{", ".join(cycle)}' for cycle in analysis['cycles']))
+    logging.info(f'Fan-in hotspots: ' + ', '.join(f'`{func_name}` ({n})' for func_name, n in analysis['fan_in_hotspots']))
+    logging.info(f'Estimated tokens (single try): prompt_tokens: {analysis["prompt_tokens"]}, completion_tokens: {analysis["completion_tokens"]}')
+    for concurrency, wall_time in analysis['wall_time'].items():
+        logging.info(f'\tPredicted wall time with {concurrency} worker(s) at {analysis["call_latency"]}s/call: {wall_time}s')
+
+
+def get_shards(code_dependancies, num_shards, symbol_weights=None):
+    symbol_graph = get_symbol_graph(code_dependancies)
+    components = strongly_connected_components(symbol_graph)
+    symbol_weights = symbol_weights or {}
+    weights = {func_name: symbol_weights.get(func_name) or count_tokens(code_dependancies[func_name][CodeData.CODE]) + 1 for func_name in symbol_graph}
+
+    # Weakly connected groups of cycles never need to exchange docs when kept on one shard
+    parent = list(range(len(components)))
+    def find(ci):
+        while parent[ci] != ci:
+            parent[ci] = parent[parent[ci]]
+            ci = parent[ci]
+        return ci
+
+    component_of = {func_name: ci for ci, component in enumerate(components) for func_name in component}
+    for func_name, deps in symbol_graph.items():
+        for dep in deps:
+            parent[find(component_of[func_name])] = find(component_of[dep])
+
+    groups = {}
+    for ci in range(len(components)):
+        groups.setdefault(find(ci), []).append(ci)
+
+    group_weight = lambda group: sum(weights[func_name] for ci in group for func_name in components[ci])
+    capacity = math.ceil(sum(weights.values()) / num_shards)
+    shards, loads = [[] for _ in range(num_shards)], [0] * num_shards
+    least_loaded = lambda: min(range(num_shards), key=lambda si: (loads[si], si))
+
+    for group in sorted(groups.values(), key=lambda group: (-group_weight(group), components[group[0]][0])):
+        si = least_loaded()
+        if loads[si] + group_weight(group) <= capacity:
+            shards[si].extend(func_name for ci in group for func_name in components[ci])
+            loads[si] += group_weight(group)
+            continue
+
+        # Too big for any shard, cut it into contiguous runs of its dependencies first order
+        for ci in group:
+            component_weight = sum(weights[func_name] for func_name in components[ci])
+            if loads[si] > 0 and loads[si] + component_weight > capacity:
+                si = least_loaded()
+            shards[si].extend(components[ci])
+            loads[si] += component_weight
+
+    return [sorted(shard) for shard in shards]
@@ -0,0 +1,92 @@
+import os
+import re
+import sys
+import logging
+import subprocess
+
+
+DIFF_FILE_HEADER = re.compile(r'^\+\+\+ (?:b/)?(.+?)\s*$')
+DIFF_HUNK_HEADER = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+LINE_RANGE = re.compile(r'^(.+?):(\d+)(?:-(\d+))?$')
+
+
+def read_diff(diff_path):
+    if diff_path == '-':
+        return sys.stdin.read()
+
+    with open(diff_path) as f:
+        return f.read()
+
+
+def parse_diff_hunks(diff_str):
+    changed_lines = {}
+    cur_file = None
+
+    for line in diff_str.split('\n'):
+
+        file_match = DIFF_FILE_HEADER.match(line)
+        if file_match:
+            cur_file = None if file_match.group(1) == '/dev/null' else file_match.group(1)
+            if cur_file:
+                changed_lines.setdefault(cur_file, set())
+            continue
+
+        hunk_match = DIFF_HUNK_HEADER.match(line)
+        if hunk_match:
+            if cur_file is None:
+                continue
+            start = int(hunk_match.group(1))
+            count = int(hunk_match.group(2)) if hunk_match.group(2) is not None else 1
+            # Pure deletions (count 0) point at the line just before the removed block
+            changed_lines[cur_file].update(range(start, start + max(count, 1)))
+            continue
+
+        range_match = LINE_RANGE.match(line.strip())
+        if range_match and not line.startswith(('+', '-', ' ')):
+            start = int(range_match.group(2))
+            end = int(range_match.group(3)) if range_match.group(3) else start
+            changed_lines.setdefault(range_match.group(1), set()).update(range(start, end + 1))
+
+    return changed_lines
+
+
+def get_diff_root(project_path):
+    # Paths in `git diff` output are relative to the top level of the repository
+    project_dir = project_path if os.path.isdir(project_path) else os.path.dirname(os.path.abspath(project_path))
+    try:
+        return subprocess.run(['git', '-C', project_dir, 'rev-parse', '--show-toplevel'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        logging.debug(f'`{project_dir}` is not inside a git repository, resolving diff paths against the current directory')
+        return os.getcwd()
+
+
+def get_changed_lines(diff_path, project_path, diff_root=None):
+    changed_lines = {}
+    diff_root = diff_root or get_diff_root(project_path)
+
+    diff_files = [(file, lines) for file, lines in parse_diff_hunks(read_diff(diff_path)).items() if os.path.splitext(file)[-1] == '.py']
+    for file, lines in diff_files:
+        file = os.path.join(diff_root, file)
+
+        if os.path.isdir(project_path):
+            rel_path = os.path.relpath(os.path.realpath(file), os.path.realpath(project_path))
+            if rel_path.startswith(os.pardir):
+                logging.debug(f'Skipping `{file}`, not inside project path `{project_path}`')
+                continue
+            # Build the path the same way `os.walk` does so it matches `CodeData.PATH`
+            path = os.path.join(project_path, rel_path)
+        elif os.path.realpath(file) == os.path.realpath(project_path):
+            path = project_path
+        else:
+            continue
+
+        if not os.path.exists(path):
+            logging.debug(f'Skipping `{path}`, file does not exist')
+            continue
+
+        changed_lines.setdefault(path, set()).update(lines)
+
+    if diff_files and not changed_lines:
+        logging.warning(f'None of the {len(diff_files)} python files in the diff are inside `{project_path}` (diff paths resolved against `{diff_root}`, use --diff_root to change)')
+
+    return changed_lines
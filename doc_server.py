@@ -0,0 +1,263 @@
+from get_code_docs import CodeData, get_reference_docs_simple_functions, get_shortened_docs
+from python_parsers import get_all_calls, get_all_call_names, get_all_imports
+from utils import generate_documentation_for_func, get_existing_short_docs
+from llm_inference import get_endpoint_pool
+from constants import LOCAL, TOK_COUNT
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import threading
+import logging
+import json
+import time
+import ast
+import os
+
+
+class DocIndex:
+
+    def __init__(self, path, llm_mode, args):
+        self.path = path
+        self.llm_mode = llm_mode
+        self.args = args
+        self.code_dependancies = CodeData()
+        self.file_imports = {}
+        self.file_mtimes = {}
+        self.file_deps = {}
+        self.ref_doc_cache = {}
+        self.lock = threading.RLock()
+
+    def python_files(self):
+        if os.path.isdir(self.path):
+            for root, dirs, files in os.walk(self.path):
+                dirs.sort()
+                for file in sorted(files):
+                    if os.path.splitext(file)[-1] == '.py':
+                        yield os.path.join(root, file)
+        elif os.path.splitext(self.path)[-1] == '.py':
+            yield self.path
+        else:
+            raise Exception(f'Could not parse path: `{self.path}`')
+
+    def drop_file(self, path):
+        file_deps = self.file_deps.pop(path, {})
+        for func_name, func_info in list(self.code_dependancies.items()):
+            if func_info[CodeData.CUSTOM] and func_info[CodeData.PATH] == path:
+                self.code_dependancies.remove(func_name)
+            elif func_name in file_deps:
+                # Duplicated names owned by another file are kept, only the dependancies added by this file are dropped
+                deps = list(func_info[CodeData.DEP])
+                for dep in file_deps[func_name]:
+                    if dep in deps:
+                        deps.remove(dep)
+                func_info[CodeData.DEP] = deps
+        self.file_imports.pop(path, None)
+        self.file_mtimes.pop(path, None)
+
+    def parse_file(self, path):
+        with open(path) as f:
+            code_str = f.read()
+
+        try:
+            self.file_imports[path] = get_all_imports(code_str)[2]
+            func_names = get_all_call_names(code_str).keys()
+            num_deps = {func_name: len(self.code_dependancies[func_name][CodeData.DEP]) for func_name in func_names}
+            get_all_calls(path, code_str, self.code_dependancies)
+            # Dependancies are appended, remember the ones added by this file so that re-parsing it replaces them
+            self.file_deps[path] = {func_name: self.code_dependancies[func_name][CodeData.DEP][num_deps[func_name]:] for func_name in func_names}
+        except SyntaxError as e:
+            logging.warning(f'Could not parse `{path}`: {e}')
+
+    def refresh(self):
+        with self.lock:
+            seen = set()
+            changed = []
+            for path in self.python_files():
+                seen.add(path)
+                mtime = os.path.getmtime(path)
+                if self.file_mtimes.get(path) != mtime:
+                    # Re-parse only files that are new or were modified since the last refresh
+                    self.drop_file(path)
+                    self.parse_file(path)
+                    self.file_mtimes[path] = mtime
+                    changed.append(path)
+
+            for path in set(self.file_mtimes) - seen:
+                self.drop_file(path)
+                changed.append(path)
+
+            if changed:
+                logging.info(f'Re-indexed {len(changed)} file(s): {", ".join(changed)}')
+
+            return changed
+
+    def import_stmts(self):
+        return list(set(stmt for stmts in self.file_imports.values() for stmt in stmts))
+
+    def reference_doc(self, func_name, func_info, import_stmts, used_tokens=None):
+        if func_info[CodeData.CUSTOM]:
+            # Custom code is referenced through its generated or existing docstring
+            if func_info[CodeData.DOC_SHORT] != '-':
+                return func_info[CodeData.DOC_SHORT]
+            doc_str = ast.get_docstring(func_info[CodeData.NODE]) or '-'
+            cache_key = (func_name, doc_str)
+        else:
+            cache_key = func_name
+
+        # Shortened docs are cached, with --ref_doc summarize shortening is an LLM call
+        with self.lock:
+            if cache_key in self.ref_doc_cache:
+                return self.ref_doc_cache[cache_key]
+
+        if func_info[CodeData.CUSTOM]:
+            doc_short = get_existing_short_docs(func_name, doc_str, self.llm_mode, self.args)
+        else:
+            doc_str = get_reference_docs_simple_functions(import_stmts, [func_name])[0]
+            doc_short = get_shortened_docs(func_name, doc_str, self.args.ref_doc, self.llm_mode, self.args, used_tokens)
+
+        with self.lock:
+            self.ref_doc_cache[cache_key] = doc_short
+        return doc_short
+
+    def snapshot(self, func_name):
+        # Copy of the symbol and its dependancies, so the LLM calls can run without holding the lock
+        with self.lock:
+            func_info = self.code_dependancies[func_name]
+            if not func_info[CodeData.CUSTOM]:
+                raise KeyError(func_name)
+
+            code_dependancies = CodeData()
+            code_dependancies.add(func_name, dict(func_info))
+            for dep_func in set(func_info[CodeData.DEP]):
+                code_dependancies.add(dep_func, {k: v for k, v in self.code_dependancies[dep_func].items() if k != CodeData.DEP})
+
+            return code_dependancies, self.import_stmts()
+
+    def symbols(self):
+        with self.lock:
+            return [
+                {'symbol': func_name, 'path': func_info[CodeData.PATH], 'type': func_info[CodeData.TYPE]}
+                for func_name, func_info in self.code_dependancies.items() if func_info[CodeData.CUSTOM]
+            ]
+
+    def document(self, func_name):
+        code_dependancies, import_stmts = self.snapshot(func_name)
+
+        # Summarizing reference docs counts towards the tokens of the request
+        ref_doc_tokens = TOK_COUNT.copy()
+        for dep_func in code_dependancies[func_name][CodeData.DEP]:
+            code_dependancies.add(dep_func, {CodeData.DOC_SHORT: self.reference_doc(dep_func, code_dependancies[dep_func], import_stmts, ref_doc_tokens)})
+
+        success, tries, reason, used_toks = generate_documentation_for_func(func_name, code_dependancies, self.llm_mode, self.args)
+        used_toks.update(ref_doc_tokens)
+        func_info = code_dependancies[func_name]
+
+        if success:
+            code_dependancies.add(
+                func_name,
+                {CodeData.DOC_SHORT: get_shortened_docs(func_name, func_info[CodeData.DOC], self.args.ref_doc, self.llm_mode, self.args, used_toks)}
+            )
+            with self.lock:
+                # Results are dropped if the code was modified or removed in the meantime
+                if self.code_dependancies[func_name][CodeData.CODE] == func_info[CodeData.CODE]:
+                    self.code_dependancies.add(func_name, {k: func_info[k] for k in [CodeData.DOC, CodeData.DOC_SHORT, CodeData.CODE_NEW]})
+
+        return {
+            'symbol': func_name,
+            'path': func_info[CodeData.PATH],
+            'success': success,
+            'tries': tries,
+            'reason': None if success else reason,
+            'documentation': func_info[CodeData.DOC],
+            'code': func_info[CodeData.CODE],
+            'code_new': func_info[CodeData.CODE_NEW],
+            'tokens': dict(used_toks),
+        }
+
+
+def watch(index, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            index.refresh()
+        except Exception as e:
+            logging.error(f'Error while refreshing index: {e}')
+
+
+def make_handler(index):
+
+    class DocRequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_document(self, func_name):
+            if not func_name:
+                return self.send_json(400, {'error': 'Missing `symbol`'})
+
+            start = time.time()
+            try:
+                out = index.document(func_name)
+            except KeyError:
+                return self.send_json(404, {'error': f'Unknown symbol: `{func_name}`'})
+            except Exception as e:
+                return self.send_json(500, {'error': str(e)})
+
+            out['elapsed'] = round(time.time() - start, 3)
+            self.send_json(200, out)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+
+            if url.path == '/symbols':
+                self.send_json(200, index.symbols())
+            elif url.path == '/document':
+                self.handle_document(parse_qs(url.query).get('symbol', [None])[0])
+            elif url.path == '/health':
+                health = {'status': 'ok', 'files': len(index.file_mtimes)}
+                if index.llm_mode == LOCAL:
+                    health['endpoints'] = get_endpoint_pool(index.args).stats()
+                self.send_json(200, health)
+            else:
+                self.send_json(404, {'error': f'Unknown endpoint: `{url.path}`'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+
+            if url.path == '/refresh':
+                self.send_json(200, {'changed': index.refresh()})
+            elif url.path == '/document':
+                try:
+                    data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or '{}')
+                except json.JSONDecodeError as e:
+                    return self.send_json(400, {'error': f'Invalid JSON: {e}'})
+                self.handle_document(data.get('symbol'))
+            else:
+                self.send_json(404, {'error': f'Unknown endpoint: `{url.path}`'})
+
+        def log_message(self, format, *args):
+            logging.debug(f'{self.address_string()} {format % args}')
+
+    return DocRequestHandler
+
+
+def serve(path, llm_mode, args):
+    index = DocIndex(path, llm_mode, args)
+    index.refresh()
+    logging.info(f'Indexed {len(index.symbols())} custom functions/methods/classes')
+
+    threading.Thread(target=watch, args=(index, args.watch_interval), daemon=True).start()
+
+    server = ThreadingHTTPServer(('localhost', args.serve), make_handler(index))
+    logging.info(f'Serving documentation requests on http://localhost:{args.serve}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,66 @@
+import sqlite3
+import hashlib
+import json
+import os
+import threading
+
+
+class DocStore:
+    
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS docs (name TEXT PRIMARY KEY, doc_short TEXT)')
+        
+    def __contains__(self, name):
+        return self.conn.execute('SELECT 1 FROM docs WHERE name = ?', (name,)).fetchone() is not None
+    
+    def get(self, name, default='-'):
+        row = self.conn.execute('SELECT doc_short FROM docs WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else default
+    
+    def put(self, name, doc_short):
+        self.update({name: doc_short})
+        
+    def update(self, docs):
+        self.conn.executemany('INSERT OR REPLACE INTO docs (name, doc_short) VALUES (?, ?)', docs.items())
+        self.conn.commit()
+        
+    def close(self):
+        self.conn.close()
+
+
+
+class SharedDocStore:
+    
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        
+    def file_path(self, name):
+        # One file per name, so several machines can write to a shared directory without locking
+        return os.path.join(self.path, hashlib.sha256(name.encode()).hexdigest() + '.json')
+        
+    def __contains__(self, name):
+        return os.path.exists(self.file_path(name))
+    
+    def get(self, name, default='-'):
+        try:
+            with open(self.file_path(name)) as f:
+                return json.load(f)['doc_short']
+        except (OSError, ValueError, KeyError):
+            return default
+    
+    def put(self, name, doc_short):
+        file_path = self.file_path(name)
+        tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'name': name, 'doc_short': doc_short}, f)
+        os.replace(tmp_path, file_path)
+        
+    def update(self, docs):
+        for name, doc_short in docs.items():
+            self.put(name, doc_short)
+            
+    def close(self):
+        pass
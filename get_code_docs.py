@@ -1,6 +1,7 @@
 import logging
 from prompts import SYSTEM_PROMPT, DOC_SUMMARIZATION_PROMPT
-from llm_inference import get_llm_output
+from llm_inference import get_llm_output, get_max_tokens, count_tokens
+from constants import DOC_TOKENS
 
 class CodeData:
     
@@ -14,6 +15,7 @@ class CodeData:
     CUSTOM = 'custom'
     PATH = 'path'
     TYPE = 'code_type'
+    TRIAGE = 'triage'
     
     def __init__(self):
         self.code_blobs = {}
@@ -28,6 +30,7 @@ class CodeData:
             CodeData.PATH: '-',
             CodeData.CODE_INDENT: '',
             CodeData.TYPE: '??',
+            CodeData.TRIAGE: '-',
         }
         
     def __getitem__(self, name):
@@ -41,10 +44,14 @@ class CodeData:
             if k == CodeData.DEP:
                 self.code_blobs[name][k] = self.code_blobs[name].get(k, []) + v
                 for func in v:
-                    self.add(func, {CodeData.DEP: [], CodeData.PATH: data.get(CodeData.PATH, '-')})
+                    if func not in self.code_blobs:
+                        self.add(func, {CodeData.DEP: [], CodeData.PATH: data.get(CodeData.PATH, '-')})
             else:
                 self.code_blobs[name][k] = v
                  
+    def remove(self, name):
+        self.code_blobs.pop(name, None)
+                 
     def dependancies(self, name):
         fobj = self.code_blobs.get(name, {})
         return len(fobj.get(CodeData.DEP, []))
@@ -130,8 +137,12 @@ def get_reference_docs_custom_functions(func, code_dependancies):
     return ref_docs
 
 
-def get_summarized_docs(func_name, doc_str, mode, args):
-   return get_llm_output(SYSTEM_PROMPT, DOC_SUMMARIZATION_PROMPT(func_name, doc_str), mode, args)
+def get_summarized_docs(func_name, doc_str, mode, args, used_tokens=None):
+   max_tokens = get_max_tokens(min(count_tokens(doc_str), DOC_TOKENS), args)
+   doc_summary, used_toks = get_llm_output(SYSTEM_PROMPT, DOC_SUMMARIZATION_PROMPT(func_name, doc_str), mode, args, max_tokens)
+   if used_tokens is not None:
+       used_tokens.update(used_toks)
+   return doc_summary
 
 
 def get_truncated_docs(func_name, doc_str):
@@ -144,12 +155,12 @@ def get_truncated_docs(func_name, doc_str):
     return trunc_doc_str
 
 
-def get_shortened_docs(func_name, doc_str, mode, llm_mode, args):
+def get_shortened_docs(func_name, doc_str, mode, llm_mode, args, used_tokens=None):
     if not doc_str or doc_str == '-':
         return doc_str
 
     if mode == 'summarize':
-        return get_summarized_docs(func_name, doc_str, llm_mode, args)
+        return get_summarized_docs(func_name, doc_str, llm_mode, args, used_tokens)
     elif mode == 'truncate':
         return get_truncated_docs(func_name, doc_str)
     elif mode == 'full':
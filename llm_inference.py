@@ -1,9 +1,12 @@
-from constants import MAX_TOKENS, TEMPERATURE,STOP_TOKENS, LOCAL, TOK_COUNT, REMOTE
+from constants import MAX_TOKENS, TEMPERATURE,STOP_TOKENS, LOCAL, TOK_COUNT, REMOTE, CHARS_PER_TOKEN, DOC_TOKENS, PATCH_COMMENT_RATIO, PATCH, MIN_MAX_TOKENS, HEALTH_CHECK_TIMEOUT, TRUNCATED_CALLS
 from collections import Counter
 import logging
 import requests
 import os
 import json
+import math
+import time
+import threading
 
 
 def clean_output(out):
@@ -12,15 +15,182 @@ def clean_output(out):
     return out.strip()
 
 
-def get_local_llm_name(port):
-    r = requests.get(f'http://localhost:{port}/v1/models')
+def count_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_completion_tokens(code_str, output_mode):
+    if output_mode == PATCH:
+        # Only the docstring and a few comments are generated
+        return DOC_TOKENS + math.ceil(count_tokens(code_str) * PATCH_COMMENT_RATIO)
+    # The model echoes the code back together with the docstring and comments
+    return count_tokens(code_str) + DOC_TOKENS
+
+
+def get_max_tokens(completion_tokens, args):
+    if not args.max_tokens_multiplier:
+        return args.max_tokens
+    return min(args.max_tokens, max(MIN_MAX_TOKENS, math.ceil(completion_tokens * args.max_tokens_multiplier)))
+
+
+def is_truncated(usage):
+    return usage.get(TRUNCATED_CALLS, 0) > 0
+
+
+def get_local_llm_name(base_url):
     output = '-'
     try:
+        r = requests.get(f'{base_url}/v1/models', timeout=HEALTH_CHECK_TIMEOUT)
         output = r.json()['data'][0]['id']
     except Exception as e:
-        raise Exception(f'Error while accessing http://localhost:{port}/v1/models: {e}')
+        raise Exception(f'Error while accessing {base_url}/v1/models: {e}')
     
     return output
+
+
+def get_local_endpoints(args):
+    endpoints = [f'http://localhost:{port}' for port in (args.port or [])]
+    endpoints += [url.rstrip('/') for url in (args.endpoints or [])]
+    return endpoints
+
+
+class EndpointPool:
+    
+    LEAST_OUTSTANDING = 'least_outstanding'
+    THROUGHPUT = 'throughput'
+    
+    def __init__(self, endpoints, strategy=LEAST_OUTSTANDING, max_failures=3, cooldown=30):
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.endpoints = {
+            url: {
+                'healthy': True,
+                'model': '-',
+                'outstanding': 0,
+                'failures': 0,
+                'ejected_at': None,
+                'requests': 0,
+                'errors': 0,
+                'latency': 0.0,
+                'completion_tokens': 0,
+            }
+            for url in endpoints
+        }
+        
+    def health_check(self, url):
+        try:
+            model = get_local_llm_name(url)
+        except Exception as e:
+            logging.warning(f'Health check failed for {url}: {e}')
+            with self.lock:
+                self.endpoints[url].update({'healthy': False, 'ejected_at': time.time()})
+            return False
+        
+        with self.lock:
+            self.endpoints[url].update({'healthy': True, 'model': model, 'failures': 0, 'ejected_at': None})
+        return True
+    
+    def health_check_all(self):
+        return [url for url in self.endpoints if self.health_check(url)]
+        
+    def readmit_endpoint(self, url):
+        if self.health_check(url):
+            logging.info(f'Re-admitted LLM endpoint {url}')
+        
+    def readmit(self):
+        # Ejected endpoints get another health check once their cooldown is over,
+        # checks run in the background so a hanging endpoint never blocks a request
+        now = time.time()
+        with self.lock:
+            due = [url for url, info in self.endpoints.items() if not info['healthy'] and now - info['ejected_at'] >= self.cooldown]
+            for url in due:
+                self.endpoints[url]['ejected_at'] = now
+                
+        for url in due:
+            threading.Thread(target=self.readmit_endpoint, args=(url,), daemon=True).start()
+                
+    def score(self, info):
+        if self.strategy == EndpointPool.THROUGHPUT:
+            # Endpoints without measurements yet are tried first
+            throughput = info['completion_tokens'] / info['latency'] if info['latency'] else float('inf')
+            return (info['outstanding'] + 1) / max(throughput, 1e-6)
+        return (info['outstanding'], info['latency'] / max(info['requests'], 1))
+    
+    def acquire(self, exclude=()):
+        self.readmit()
+        with self.lock:
+            candidates = [(url, info) for url, info in self.endpoints.items() if info['healthy'] and url not in exclude]
+            if not candidates:
+                raise Exception(f'No healthy LLM endpoint available out of: {", ".join(self.endpoints)}')
+                
+            url, info = min(candidates, key=lambda x: self.score(x[1]))
+            info['outstanding'] += 1
+            return url
+        
+    def release(self, url, latency, usage=None, success=True):
+        with self.lock:
+            info = self.endpoints[url]
+            info['outstanding'] -= 1
+            if success:
+                info['failures'] = 0
+                info['requests'] += 1
+                info['latency'] += latency
+                info['completion_tokens'] += (usage or {}).get('completion_tokens', 0)
+            else:
+                info['failures'] += 1
+                info['errors'] += 1
+                if info['healthy'] and info['failures'] >= self.max_failures:
+                    info['healthy'] = False
+                    info['ejected_at'] = time.time()
+                    logging.warning(f'Ejected LLM endpoint {url} after {info["failures"]} consecutive failures')
+                    
+    def stats(self):
+        with self.lock:
+            return {
+                url: {
+                    'healthy': info['healthy'],
+                    'model': info['model'],
+                    'requests': info['requests'],
+                    'errors': info['errors'],
+                    'avg_latency': round(info['latency'] / info['requests'], 3) if info['requests'] else None,
+                    'tokens_per_sec': round(info['completion_tokens'] / info['latency'], 1) if info['latency'] else None,
+                }
+                for url, info in self.endpoints.items()
+            }
+            
+    def log_stats(self):
+        for url, info in self.stats().items():
+            logging.info(f'LLM endpoint {url}: ' + ', '.join(f'{k}: {v}' for k,v in info.items()))
+            
+    def save_stats(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+
+
+def load_call_latency(stats_path):
+    # Average seconds per LLM call over all endpoints of a previous run
+    try:
+        with open(stats_path) as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    num_requests = sum(info['requests'] for info in stats.values())
+    if not num_requests:
+        return None
+    return sum(info['avg_latency'] * info['requests'] for info in stats.values() if info['requests']) / num_requests
+
+
+ENDPOINT_POOL = None
+
+
+def get_endpoint_pool(args):
+    global ENDPOINT_POOL
+    if ENDPOINT_POOL is None:
+        ENDPOINT_POOL = EndpointPool(get_local_endpoints(args), args.balance)
+    return ENDPOINT_POOL
     
 
 def get_llm_api_output(url, headers, model, system_prompt, prompt, temperature, max_tokens):
@@ -47,13 +217,39 @@ def get_llm_api_output(url, headers, model, system_prompt, prompt, temperature,
     try:
         output = r.json()['choices'][0]['message']['content'].lstrip('\n').strip('\n').strip()
         usage = Counter(r.json()['usage'])
+        # Counted with the token usage so truncation can be checked per call and reported per run
+        usage[TRUNCATED_CALLS] = int(r.json()['choices'][0].get('finish_reason') == 'length')
     except Exception as e:
         raise Exception(f'Error while accessing {url}: {e}')
         
     return clean_output(output), usage    
 
 
-def get_llm_output(system_prompt, prompt, mode, args):
+def get_local_llm_output(system_prompt, prompt, args, max_tokens):
+    pool = get_endpoint_pool(args)
+    tried = []
+    
+    # Fail over to the next best endpoint until every endpoint was tried once
+    while True:
+        base_url = pool.acquire(exclude=tried)
+        start = time.time()
+        try:
+            output, usage = get_llm_api_output(f'{base_url}/v1/chat/completions', {}, 'dummy', system_prompt, prompt, args.temperature, max_tokens)
+        except Exception as e:
+            pool.release(base_url, time.time() - start, success=False)
+            tried.append(base_url)
+            if len(tried) == len(pool.endpoints):
+                raise
+            logging.debug(f'LLM endpoint {base_url} failed, retrying on another endpoint: {e}')
+            continue
+        
+        pool.release(base_url, time.time() - start, usage)
+        return output, usage
+
+
+def get_llm_output(system_prompt, prompt, mode, args, max_tokens=None):
+    max_tokens = max_tokens or args.max_tokens
+    
     if mode == REMOTE:
         api_key = args.api_key if args.api_key else os.environ[args.api_key_env]
         url = f'{args.api_base_url}/chat/completions'
@@ -63,10 +259,8 @@ def get_llm_output(system_prompt, prompt, mode, args):
         }
         model = args.model
     elif mode == LOCAL:
-        url = f'http://localhost:{args.port}/v1/chat/completions'
-        headers = {}
-        model = 'dummy'
+        return get_local_llm_output(system_prompt, prompt, args, max_tokens)
     else:
         raise Exception(f'Unknown mode: `{mode}` for LLM inference')
     
-    return get_llm_api_output(url, headers, model, system_prompt, prompt, args.temperature, args.max_tokens)
\ No newline at end of file
+    return get_llm_api_output(url, headers, model, system_prompt, prompt, args.temperature, max_tokens)
\ No newline at end of file
@@ -1,7 +1,10 @@
-from get_code_docs import CodeData, get_reference_docs_simple_functions, get_reference_docs_custom_functions, get_shortened_docs
-from constants import LOCAL, REMOTE
-from llm_inference import get_local_llm_name
-from utils import get_args, generate_report, get_code_dependancies_and_imports, generate_documentation_for_custom_calls, replace_modified_functions
+from get_code_docs import CodeData
+from constants import LOCAL, REMOTE, DEFAULT_CALL_LATENCY
+from llm_inference import get_endpoint_pool, load_call_latency
+from utils import get_args, generate_report, get_code_dependancies_and_imports, generate_documentation_for_custom_calls, replace_modified_functions, restrict_to_changed_symbols, add_reference_docs, log_token_usage, document_in_partitions, document_shard, merge_shard_results
+from diff_parsers import get_changed_lines
+from doc_server import serve
+from dependency_graph import analyze_graph, export_graph, log_graph_analysis
 
 import logging
 
@@ -10,6 +13,16 @@ logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S',
 )    
+
+
+def save_endpoint_stats(llm_mode, args):
+    if llm_mode != LOCAL:
+        return
+    pool = get_endpoint_pool(args)
+    pool.log_stats()
+    pool.save_stats(args.endpoint_stats)
+    logging.info(f'Saved LLM endpoint statistics in {args.endpoint_stats}')
+
     
 def main():
     
@@ -20,35 +33,74 @@ def main():
         
     logging.info(f'Project path: {args.path}')
     
-    llm_mode = LOCAL if args.port else REMOTE
-    model_name = get_local_llm_name(args.port) if llm_mode == LOCAL else args.model
+    if args.merge:
+        merge_shard_results(args.path, args.merge, args)
+        return
+    
+    if args.graph:
+        code_dependancies, _ = get_code_dependancies_and_imports(args.path)
+        call_latency = args.call_latency or load_call_latency(args.endpoint_stats)
+        if call_latency:
+            logging.info(f'Using {call_latency:.2f}s per LLM call' + ('' if args.call_latency else f' measured in {args.endpoint_stats}'))
+        else:
+            call_latency = DEFAULT_CALL_LATENCY
+            logging.warning(f'No measured LLM latency in {args.endpoint_stats}, assuming {call_latency}s per call (use --call_latency)')
+        analysis = analyze_graph(code_dependancies, call_latency, args.concurrency, args.output_mode)
+        log_graph_analysis(analysis)
+        
+        graph_output = args.graph_output or f'dep_graph_{args.path.split("/")[-1]}.{args.graph}'
+        export_graph(code_dependancies, analysis, args.graph, graph_output)
+        logging.info(f'Saved dependancy graph in {graph_output}')
+        return
+    
+    llm_mode = LOCAL if (args.port or args.endpoints) else REMOTE
+    if llm_mode == LOCAL:
+        pool = get_endpoint_pool(args)
+        if not pool.health_check_all():
+            raise Exception(f'None of the local LLM endpoints are reachable: {", ".join(pool.endpoints)}')
+        model_name = ', '.join(sorted(set(info['model'] for info in pool.stats().values() if info['healthy'])))
+    else:
+        model_name = args.model
     logging.info(f'Using {llm_mode} LLM: {model_name}')
     
-    code_dependancies, import_stmts = get_code_dependancies_and_imports(args.path)
-    logging.debug(f'Found {len(code_dependancies.keys())} functions/methods/clases: ')
-
-    simple_funcs = [func_name for func_name in code_dependancies.keys() if code_dependancies.dependancies(func_name) == 0]
-    reference_docs = get_reference_docs_simple_functions(import_stmts, simple_funcs)
-    logging.info(f'Reference documentation found for {len([x for x in reference_docs if x != "-"])}/{len(code_dependancies.keys())} calls')
-
-    num_simple_funcs = len(simple_funcs)
-    logging.info(f'Using `{args.ref_doc}` strategy to shorten docs')
+    if args.serve:
+        serve(args.path, llm_mode, args)
+        return
+    
+    if args.shard:
+        document_shard(args.path, llm_mode, args)
+        save_endpoint_stats(llm_mode, args)
+        return
     
-    for i,(func,known_doc) in enumerate(zip(simple_funcs, reference_docs)):
-        if args.ref_doc == 'summarize' and (num_simple_funcs <=10 or (i+1)%(round(num_simple_funcs/10)) == 0):
-            logging.info(f'\t[{i+1}/{num_simple_funcs}] {round(100*(i+1)/num_simple_funcs)}% done')
+    if args.partition_size:
+        document_in_partitions(args.path, llm_mode, args)
+        save_endpoint_stats(llm_mode, args)
+        return
+    
+    if args.diff:
+        changed_lines = get_changed_lines(args.diff, args.path, args.diff_root)
+        code_dependancies, import_stmts = get_code_dependancies_and_imports(args.path, files=sorted(changed_lines.keys()))
+        if not restrict_to_changed_symbols(code_dependancies, changed_lines, args.path, llm_mode, args):
+            logging.info('No changed functions/methods/classes found in diff, nothing to document')
+            return
+    else:
+        code_dependancies, import_stmts = get_code_dependancies_and_imports(args.path)
+    logging.debug(f'Found {len(code_dependancies.keys())} functions/methods/clases: ')
 
-        code_dependancies.add(
-            func, 
-            {CodeData.DOC_SHORT: get_shortened_docs(func, known_doc, args.ref_doc, llm_mode, args)}
-        )
+    simple_funcs = [func_name for func_name in code_dependancies.keys() if code_dependancies.dependancies(func_name) == 0 and code_dependancies[func_name][CodeData.DOC_SHORT] == '-']
+    ref_doc_tokens = add_reference_docs(code_dependancies, import_stmts, simple_funcs, llm_mode, args)
         
-    generate_documentation_for_custom_calls(code_dependancies, llm_mode, args)
+    total_tokens = ref_doc_tokens + generate_documentation_for_custom_calls(code_dependancies, llm_mode, args, spent_tokens=ref_doc_tokens)
+    if args.ref_doc == 'summarize':
+        logging.info('Token usage including summarized reference documentation')
+        log_token_usage(total_tokens, args)
 
     replace_modified_functions(code_dependancies, args.path)
     
     generate_report(code_dependancies, f'doc_report_{args.path.split("/")[-1]}.csv')
     logging.info(f'Saved Documentation report in ./doc_report_{args.path.split("/")[-1]}.csv')
+    
+    save_endpoint_stats(llm_mode, args)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
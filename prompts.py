@@ -52,4 +52,42 @@ Function: {func}
 {doc}
 
 ### Summarized documentation
-'''
\ No newline at end of file
+'''
+
+
+PATCH_INSTRUCTIONS = '''\
+- Generate documentation for the python function/class given below, its lines are numbered.
+- The documentation should contain:
+- Docstring
+    - Should contain:
+        - A single line summary 
+        - Input: Short descriptions of each input parameter
+        - Returns: Short descriptions of each output parameter
+        - Raises: Short description of failure cases and exceptions raised by the class, method, or function
+    - Leave it empty if the original class, method, or function already has a docstring
+- Inline comments
+    - Short inline comments for blocks of code that are hard to understand
+    - Only write such comments for each block of code, not for every line
+    - Each comment is placed on its own line just above the given line number
+- You also have access to reference documentation for sub-functions and sub-classes used in the original class, method, or function. These should be used for enhanced context for better documentation.
+- Do not repeat the code.
+- Only reply with a JSON object of the form {"docstring": "...", "comments": [{"line": <line number>, "comment": "..."}]} followed by the stop token: <STOP>'''
+
+
+number_lines = lambda code: '\n'.join(f'{i+1:>4}| {line}' for i, line in enumerate(code.split('\n')))
+
+
+DOC_PATCH_PROMPT = lambda func, ref_docs: f'''\
+### Guidelines:
+{PATCH_INSTRUCTIONS}
+
+### Reference documentation:
+{format_docs(ref_docs)}
+
+### Original code block:
+```python
+{number_lines(func)}
+```
+
+### Documentation patch:
+'''
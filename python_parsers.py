@@ -1,6 +1,6 @@
 import ast
 from collections import deque
-from constants import CALLS_TO_INGORE
+from constants import CALLS_TO_INGORE, CODE, PATCH
 import re
 from itertools import zip_longest
 from typing import Union
@@ -10,6 +10,8 @@ import tokenize
 import copy
 import subprocess
 import sys
+import json
+import textwrap
 
 
 def to_remove(call_str):
@@ -94,6 +96,38 @@ def get_all_calls(path, code_str, funcs):
             )
 
 
+def get_all_call_names(code_str):
+    calls = {}
+    tree = ast.parse(code_str)
+    
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef):
+            if isinstance(node, ast.ClassDef):
+                for child_node in node.body:
+                    if isinstance(child_node, ast.FunctionDef):
+                        calls[child_node.name] = get_func_calls(child_node)
+                        
+            calls[node.name] = get_func_calls(node)
+            
+    return calls
+
+
+def get_all_docstrings(code_str):
+    docs = {}
+    tree = ast.parse(code_str)
+    
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef):
+            if isinstance(node, ast.ClassDef):
+                for child_node in node.body:
+                    if isinstance(child_node, ast.FunctionDef):
+                        docs[child_node.name] = ast.get_docstring(child_node) or '-'
+                        
+            docs[node.name] = ast.get_docstring(node) or '-'
+            
+    return docs
+
+
 def get_all_imports(code_str):
     libs = []
     import_stmts = []
@@ -163,6 +197,127 @@ def parse_commented_function(func_name, func_str):
     return func_str, ast_code, success, reason
 
 
+def parse_doc_patch(func_name, patch_str):
+    
+    patch, success, reason = None, False, None
+    
+    try:
+        patch = json.loads(patch_str[patch_str.index('{'):patch_str.rindex('}')+1])
+    except Exception as e:
+        reason = f'Patch parse error `({repr(e)[:50]}...)`'
+        return patch, success, reason
+    
+    if not isinstance(patch, dict) or not isinstance(patch.get('docstring', ''), str) or not isinstance(patch.get('comments', []), list):
+        return None, False, f'Patch type error `({type(patch)})`'
+    
+    comments = []
+    for comment in patch.get('comments', []):
+        try:
+            comments.append((int(comment['line']), str(comment['comment'])))
+        except (KeyError, TypeError, ValueError):
+            logging.debug(f'\t\tIgnoring malformed comment in patch for `{func_name}`: {comment}')
+            
+    return {'docstring': patch.get('docstring', '').strip(), 'comments': comments}, True, reason
+
+
+def apply_doc_patch(func_name, code_str, func_node, code_indent, patch):
+    
+    code_lines = code_str.split('\n')
+    insertions = []
+    
+    has_docstring = ast.get_docstring(func_node) is not None
+    body_ind = func_node.body[0].lineno - func_node.lineno
+    # Comments can only go above the first line of a statement, not inside multi-line strings or continuation lines
+    anchors = set(node.lineno - func_node.lineno for node in ast.walk(func_node) if isinstance(node, ast.stmt) and node is not func_node)
+    get_line_indent = lambda line: line[:len(line) - len(line.lstrip())]
+    
+    if patch['docstring'] and not has_docstring:
+        if body_ind == 0:
+            return None, None, False, 'Patch error `(body on the same line as definition)`'
+        
+        indent = get_line_indent(code_lines[body_ind])
+        doc_lines = patch['docstring'].replace('\\', '\\\\').replace('"""', '\\"\\"\\"').split('\n')
+        if doc_lines[-1].endswith('"') and (len(doc_lines[-1]) - 1 - len(doc_lines[-1][:-1].rstrip('\\'))) % 2 == 0:
+            # An unescaped quote right before the closing quotes would end the string early
+            doc_lines[-1] = doc_lines[-1][:-1] + '\\"'
+        doc_lines = [indent + '"""' + doc_lines[0]] + [indent + line if line.strip() else '' for line in doc_lines[1:]]
+        insertions.append((body_ind, 0, doc_lines + [indent + '"""'] if len(doc_lines) > 1 else [doc_lines[0] + '"""']))
+        
+    for line_no, comment in patch['comments']:
+        # Line numbers are 1-based, comments are never placed above the definition itself
+        if line_no < 2 or line_no > len(code_lines):
+            logging.debug(f'\t\tIgnoring comment for line {line_no} in patch for `{func_name}`')
+            continue
+        # Comments pointing at a blank line go above the next code line, with its indentation
+        ind = next((i for i in range(line_no-1, len(code_lines)) if code_lines[i].strip()), None)
+        if ind is None:
+            logging.debug(f'\t\tIgnoring comment for trailing blank line {line_no} in patch for `{func_name}`')
+            continue
+        if ind not in anchors:
+            logging.debug(f'\t\tIgnoring comment for line {line_no} which does not start a statement in patch for `{func_name}`')
+            continue
+        indent = get_line_indent(code_lines[ind])
+        comment_lines = [line.strip().lstrip('#').strip() for line in comment.strip().split('\n')]
+        insertions.append((ind, 1, [f'{indent}# {line}' for line in comment_lines if line]))
+        
+    # Insert bottom up so line numbers stay valid, the docstring goes above comments for the same line
+    for ind, _, new_lines in sorted(insertions, key=lambda x: x[:2], reverse=True):
+        code_lines = code_lines[:ind] + new_lines + code_lines[ind:]
+        
+    new_code_str = '\n'.join(code_lines)
+    
+    try:
+        new_func_node = ast.parse(textwrap.dedent(code_indent + new_code_str)).body[0]
+    except Exception as e:
+        return new_code_str, None, False, f'Parse error `({repr(e)[:50]}...)`'
+    
+    return new_code_str, new_func_node, True, None
+
+
+def get_output_mode(func_node, output_mode):
+    # Patches cannot insert a docstring when the body starts on the definition line, such functions are short enough to re-emit
+    if output_mode == PATCH and func_node.body[0].lineno == func_node.lineno:
+        return CODE
+    return output_mode
+
+
+def rename_definition(code_str, old_name, new_name):
+    return re.sub(rf'^(\s*(?:async\s+)?(?:def|class)\s+){re.escape(old_name)}\b', rf'\g<1>{new_name}', code_str, count=1, flags=re.MULTILINE)
+
+
+def is_trivial(func_node):
+    if not isinstance(func_node, ast.FunctionDef):
+        return False
+    
+    body = remove_docstring(func_node).body
+    if not body:
+        return True
+    if len(body) != 1 or not isinstance(body[0], (ast.Pass, ast.Return, ast.Assign, ast.AnnAssign, ast.Expr)):
+        return False
+    
+    # Getters, setters and plain delegation to a single other call
+    return len([node for node in ast.walk(body[0]) if isinstance(node, ast.Call)]) <= 1 and not any(isinstance(node, (ast.Lambda, ast.comprehension, ast.IfExp)) for node in ast.walk(body[0]))
+
+
+def get_template_docstring(func_node):
+    body = remove_docstring(func_node).body
+    stmt = body[0] if body else ast.Pass()
+    
+    if isinstance(stmt, ast.Pass):
+        return 'Do nothing.'
+    elif isinstance(stmt, ast.Return) and stmt.value is None:
+        return 'Return None.'
+    elif isinstance(stmt, ast.Return) and isinstance(stmt.value, ast.Call):
+        return f'Return the result of `{ast.unparse(stmt.value.func)}`.'
+    elif isinstance(stmt, ast.Return):
+        return f'Return `{ast.unparse(stmt.value)}`.'
+    elif isinstance(stmt, (ast.Assign, ast.AnnAssign)):
+        targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+        return f'Set {", ".join(f"`{ast.unparse(target)}`" for target in targets)}.'
+    else:
+        return f'Call `{ast.unparse(stmt.value.func) if isinstance(stmt.value, ast.Call) else ast.unparse(stmt.value)}`.'
+
+
 def remove_docstring(func_node):    
     func_node_copy = copy.deepcopy(func_node)
     func_node_copy.body = [node for node in func_node_copy.body if not (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant))]
@@ -297,4 +452,17 @@ def get_indent_from_file(path):
         for (tok_type, tok_str, _, _, _) in tokenize.generate_tokens(f.readline):
             if tok_type == tokenize.INDENT:
                 return tok_str
-    logging.error(f'Could not find indent (tabs/spaces) from path: `{path}`')
\ No newline at end of file
+    logging.error(f'Could not find indent (tabs/spaces) from path: `{path}`')
+
+
+def get_node_lines(node):
+    start = min([node.lineno] + [dec.lineno for dec in node.decorator_list])
+    node_lines = set(range(start, node.end_lineno + 1))
+
+    # Lines belonging to methods are owned by the method, not by the class
+    if isinstance(node, ast.ClassDef):
+        for child_node in node.body:
+            if isinstance(child_node, ast.FunctionDef):
+                node_lines -= get_node_lines(child_node)
+
+    return node_lines
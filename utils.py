@@ -1,8 +1,10 @@
-from python_parsers import get_all_calls, get_all_imports, parse_commented_function, same_ast_with_reason, remove_docstring, replace_func
-from get_code_docs import CodeData, get_reference_docs_custom_functions, get_shortened_docs
-from prompts import SYSTEM_PROMPT, DOC_GENERATION_PROMPT
-from constants import TOK_COUNT
-from llm_inference import get_llm_output
+from python_parsers import get_all_calls, get_all_imports, get_all_docstrings, parse_commented_function, parse_doc_patch, apply_doc_patch, same_ast_with_reason, remove_docstring, replace_func, get_node_lines, rename_definition, is_trivial, get_template_docstring, get_output_mode
+from get_code_docs import CodeData, get_reference_docs_simple_functions, get_reference_docs_custom_functions, get_shortened_docs
+from dependency_graph import get_symbol_index, get_partitions, estimate_tokens, get_shards, get_symbol_weights
+from doc_store import DocStore, SharedDocStore
+from prompts import SYSTEM_PROMPT, DOC_GENERATION_PROMPT, DOC_PATCH_PROMPT
+from constants import TOK_COUNT, MAX_TOKENS, CODE, PATCH, DOCUMENTED, TRIVIAL, NEEDS_LLM, OTHER_SHARD
+from llm_inference import get_llm_output, get_max_tokens, is_truncated, estimate_completion_tokens, count_tokens
 
 import argparse
 from argparse import RawTextHelpFormatter
@@ -11,7 +13,33 @@ import logging
 import ast
 import os
 import math
+import tempfile
+import textwrap
+import hashlib
+import json
+import time
+import threading
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def shard_type(value):
+    try:
+        shard_index, num_shards = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Shard must be given as i/N, got: `{value}`')
+    if not 1 <= shard_index <= num_shards:
+        raise argparse.ArgumentTypeError(f'Shard index must be between 1 and {num_shards}, got: `{value}`')
+    return shard_index, num_shards
+
+
+def comma_list(item_type):
+    def parse(value):
+        try:
+            return [item_type(item) for item in value.split(',') if item]
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Expected a comma separated list, got: `{value}`')
+    return parse
 
 
 def get_args():
@@ -51,8 +79,32 @@ def get_args():
 
     parser.add_argument(
         "-p", "--port",
+        type=comma_list(int),
+        action='extend',
+        help="Port(s) where Local LLM server(s) are hosted, comma separated or repeated (e.g. --port 8080,8081)"
+    )
+
+    parser.add_argument(
+        "--endpoints",
+        type=comma_list(str),
+        action='extend',
+        help="Base URL(s) of Local LLM servers, comma separated or repeated (e.g. --endpoints http://gpu-box:8080)"
+    )
+
+    parser.add_argument(
+        "--balance",
+        choices=['least_outstanding', 'throughput'],
+        default='least_outstanding',
+        help="Strategy to spread requests across several Local LLM servers. Supported choices are:\
+            \nleast_outstanding - Send to the server with the fewest requests in flight\
+            \nthroughput        - Weight servers by their measured tokens/second"
+    )
+
+    parser.add_argument(
+        "--workers",
         type=int,
-        help="Port where Local LLM server is hosted"
+        default=1,
+        help="Number of functions/methods/classes documented concurrently, useful with several LLM servers"
     )
         
     parser.add_argument(
@@ -83,8 +135,180 @@ def get_args():
     parser.add_argument(
         "--max_tokens",
         type=int,
-        default=2048,
-        help="Maximum number of tokens that the LLM is allowed to generate"
+        default=MAX_TOKENS,
+        help="Maximum number of tokens that the LLM is allowed to generate in a single call"
+    )
+
+    parser.add_argument(
+        "--max_tokens_multiplier",
+        type=float,
+        default=1.5,
+        help="Size the token limit of each LLM call as this multiple of the expected output length (based on the\
+            \ninput code and --output_mode), capped at --max_tokens. The limit is doubled on retries after truncation\
+            \nUse 0 to always use --max_tokens"
+    )
+
+    parser.add_argument(
+        "--output_mode",
+        choices=[CODE, PATCH],
+        default=CODE,
+        help="What the LLM is asked to reply with. Supported choices are:\
+            \ncode  - The complete documented function/method/class\
+            \npatch - Only a docstring and a list of (line, comment) insertions which are applied locally,\
+            \n        uses several times fewer completion tokens\
+            \n\"code\" is used as the default mode"
+    )
+
+    parser.add_argument(
+        "--triage",
+        choices=['none', 'documented', 'all'],
+        default='none',
+        help="Static checks that avoid LLM calls. Supported choices are:\
+            \nnone       - Send every function/method/class to the LLM\
+            \ndocumented - Keep code which already has a docstring as it is and use that docstring as reference\
+            \nall        - Also handle trivial one statement functions (getters, setters, delegation) using --trivial\
+            \n\"none\" is used as the default"
+    )
+
+    parser.add_argument(
+        "--trivial",
+        choices=['template', 'skip'],
+        default='template',
+        help="How trivial functions are handled with --triage all. Supported choices are:\
+            \ntemplate - Add a short docstring generated from the code\
+            \nskip     - Leave the code as it is\
+            \n\"template\" is used as the default"
+    )
+
+    parser.add_argument(
+        "--no_dedup",
+        action='store_true',
+        help="Send one LLM request per function/method/class even if several of them have identical code"
+    )
+
+    parser.add_argument(
+        "--token_budget",
+        type=int,
+        help="Maximum number of prompt + completion tokens to spend. The most valuable functions/methods/classes\
+            \n(public, most used, largest) are documented first and the run stops before the budget is exceeded"
+    )
+
+    parser.add_argument(
+        "--cost_budget",
+        type=float,
+        help="Maximum cost to spend, requires --prices"
+    )
+
+    parser.add_argument(
+        "--prices",
+        type=float,
+        nargs=2,
+        metavar=('PROMPT_PRICE', 'COMPLETION_PRICE'),
+        help="Price per million prompt and completion tokens, used for --cost_budget and cost reporting"
+    )
+
+    parser.add_argument(
+        "--diff",
+        help="Only document functions/methods/classes touched by the given diff.\
+            \nPath to the output of `git diff --unified=0` (use \"-\" to read from stdin)\
+            \nLines of the form `<file>:<start>-<end>` are also accepted"
+    )
+
+    parser.add_argument(
+        "--diff_root",
+        help="Directory that the paths in --diff are relative to. Defaults to the top level of the git repository\
+            \ncontaining the project path, or the current directory outside of git"
+    )
+
+    parser.add_argument(
+        "--serve",
+        type=int,
+        help="Run as a daemon which keeps the parsed project warm and serves documentation\
+            \nrequests for single functions/methods/classes over HTTP on the given port"
+    )
+
+    parser.add_argument(
+        "--watch_interval",
+        type=float,
+        default=2.0,
+        help="Seconds between checks for modified files when running with --serve"
+    )
+
+    parser.add_argument(
+        "--partition_size",
+        type=int,
+        help="Process the project in partitions of at most this many files (whole packages are kept together)\
+            \nFinished partitions are written to disk so memory grows with partition size, not project size"
+    )
+
+    parser.add_argument(
+        "--spill_dir",
+        help="Directory for the reference documentation store used with --partition_size. Defaults to a temporary directory"
+    )
+
+    parser.add_argument(
+        "--shard",
+        type=shard_type,
+        help="Only document shard i of N (given as i/N) of the deterministically partitioned dependancy graph\
+            \nResults are written to --shard_output and combined with --merge"
+    )
+
+    parser.add_argument(
+        "--shard_output",
+        help="Results file for --shard. Defaults to ./lmdocs_shard_<i>_of_<N>.json"
+    )
+
+    parser.add_argument(
+        "--doc_store",
+        help="Shared directory used by shards to exchange documentation of functions/methods/classes\
+            \nwhich are documented by another shard"
+    )
+
+    parser.add_argument(
+        "--shard_wait",
+        type=float,
+        default=0,
+        help="Seconds to wait for documentation from other shards to appear in --doc_store"
+    )
+
+    parser.add_argument(
+        "--merge",
+        nargs='+',
+        help="Combine the results files of all shards, update the project files and write a single report"
+    )
+
+    parser.add_argument(
+        "--graph",
+        choices=['dot', 'json'],
+        help="Only analyze the project: export its dependancy graph in the given format and report\
+            \ntopological levels, critical path, cycles, fan-in hotspots, estimated tokens and predicted wall time"
+    )
+
+    parser.add_argument(
+        "--graph_output",
+        help="Output path for --graph. Defaults to ./dep_graph_<project name>.<format>"
+    )
+
+    parser.add_argument(
+        "--call_latency",
+        type=float,
+        help="Seconds per LLM call used by --graph to predict wall time. Defaults to the latency measured\
+            \nin the previous local run (--endpoint_stats), or 10 seconds if there is none"
+    )
+
+    parser.add_argument(
+        "--endpoint_stats",
+        default='lmdocs_endpoint_stats.json',
+        help="File where the per server latency and throughput of local runs is saved, read by --graph.\
+            \nDefaults to ./lmdocs_endpoint_stats.json"
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs='+',
+        default=[1, 2, 4, 8],
+        help="Concurrency levels for which --graph predicts wall time"
     )
 
     args = parser.parse_args()
@@ -96,14 +320,25 @@ def get_args():
 def verify_args(args):
     parser = argparse.ArgumentParser()
 
-    if not args.port and (not args.api_key and not args.api_key_env):
-        raise parser.error('Use --port for a local LLM or --api_key/--api_key_env for remote LLM inference engine')
+    if args.cost_budget and not args.prices:
+        raise parser.error('--cost_budget requires --prices')
     
-    if not args.port and (args.model and not (args.api_key or args.api_key_env)):
+    # Each of these selects a different run mode, they cannot be combined
+    modes = [f'--{mode}' for mode in ['merge', 'graph', 'serve', 'shard', 'partition_size', 'diff'] if getattr(args, mode) is not None]
+    if len(modes) > 1:
+        raise parser.error(f'{" and ".join(modes)} cannot be used together')
+    
+    if args.graph or args.merge:
+        return
+
+    if not (args.port or args.endpoints) and (not args.api_key and not args.api_key_env):
+        raise parser.error('Use --port/--endpoints for a local LLM or --api_key/--api_key_env for remote LLM inference engine')
+    
+    if not (args.port or args.endpoints) and (args.model and not (args.api_key or args.api_key_env)):
         raise parser.error('One of --api_key or --api_key_env must be specified')
 
 
-def generate_report(code_deps, report_path):
+def generate_report(code_deps, report_path, append=False):
     data = []
     for k,v in code_deps.items():
         if v[CodeData.CUSTOM]:
@@ -113,19 +348,35 @@ def generate_report(code_deps, report_path):
                 'documentation': v[CodeData.DOC],
                 'shortened documentation': v[CodeData.DOC_SHORT],                
                 'code_before': v[CodeData.CODE],
-                'code_after': v[CodeData.CODE_NEW]
+                'code_after': v[CodeData.CODE_NEW],
+                'triage': v[CodeData.TRIAGE],
             })
         
-    pd.DataFrame(data).to_csv(report_path, index=False)
+    if append and os.path.exists(report_path):
+        pd.DataFrame(data).to_csv(report_path, index=False, mode='a', header=False)
+    else:
+        pd.DataFrame(data).to_csv(report_path, index=False)
 
 
-def get_code_dependancies_and_imports(path):
+def get_code_dependancies_and_imports(path, files=None):
     import_stmts = []
     code_dependancies = CodeData()
     
-    if os.path.isdir(path):
-        for root, _, files in os.walk(path):
-            for file in files:
+    if files is not None:
+        for path in files:
+            logging.info(f'Extracting dependancies from {path}')
+            
+            with open(path) as f:    
+                code_str = f.read()
+                
+            import_stmts.extend(get_all_imports(code_str)[2])
+            get_all_calls(path, code_str, code_dependancies)
+    
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            # Walk in a fixed order, the last parsed definition of a duplicated name is kept
+            dirs.sort()
+            for file in sorted(files):
                 if os.path.splitext(file)[-1] == '.py':
                     path = os.path.join(root, file)
                     logging.info(f'Extracting dependancies from {path}')
@@ -153,128 +404,678 @@ def get_code_dependancies_and_imports(path):
     return code_dependancies, import_stmts
 
 
-def generate_documentation_for_custom_calls(code_dependancies, llm_mode, args):
-    custom_funcs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM]]
+def add_reference_docs(code_dependancies, import_stmts, simple_funcs, llm_mode, args):
+    reference_docs = get_reference_docs_simple_functions(import_stmts, simple_funcs)
+    logging.info(f'Reference documentation found for {len([x for x in reference_docs if x != "-"])}/{len(code_dependancies.keys())} calls')
+
+    num_simple_funcs = len(simple_funcs)
+    logging.info(f'Using `{args.ref_doc}` strategy to shorten docs')
+    
+    used_tokens = TOK_COUNT.copy()
+    for i,(func,known_doc) in enumerate(zip(simple_funcs, reference_docs)):
+        if args.ref_doc == 'summarize' and (num_simple_funcs <=10 or (i+1)%(round(num_simple_funcs/10)) == 0):
+            logging.info(f'\t[{i+1}/{num_simple_funcs}] {round(100*(i+1)/num_simple_funcs)}% done')
+
+        code_dependancies.add(
+            func, 
+            {CodeData.DOC_SHORT: get_shortened_docs(func, known_doc, args.ref_doc, llm_mode, args, used_tokens)}
+        )
+        
+    return used_tokens
+
+
+def restrict_to_changed_symbols(code_dependancies, changed_lines, path, llm_mode, args):
+    changed_funcs = []
+    for func_name, func_info in code_dependancies.items():
+        if func_info[CodeData.CUSTOM] and get_node_lines(func_info[CodeData.NODE]) & changed_lines.get(func_info[CodeData.PATH], set()):
+            changed_funcs.append(func_name)
+            
+    needed_funcs = set(changed_funcs)
+    for func_name in changed_funcs:
+        needed_funcs.update(code_dependancies[func_name][CodeData.DEP])
+        
+    # Dependancies defined in unchanged files were not parsed, read their existing docstrings from the defining files
+    unparsed_funcs = set(func_name for func_name in needed_funcs if not code_dependancies[func_name][CodeData.CUSTOM])
+    if unparsed_funcs:
+        for file_path, docs in get_symbol_index(path, get_all_docstrings).items():
+            if file_path in changed_lines:
+                continue
+            for func_name in sorted(unparsed_funcs & docs.keys()):
+                code_dependancies.add(
+                    func_name,
+                    {
+                        CodeData.PATH: file_path,
+                        CodeData.DOC: docs[func_name],
+                        CodeData.DOC_SHORT: get_existing_short_docs(func_name, docs[func_name], llm_mode, args),
+                    }
+                )
+                
+    for func_name in list(code_dependancies.keys()):
+        if func_name not in needed_funcs:
+            code_dependancies.remove(func_name)
+        elif func_name not in changed_funcs and code_dependancies[func_name][CodeData.CUSTOM]:
+            # Unchanged custom code is only used as reference, reuse its existing docstring
+            doc_str = ast.get_docstring(code_dependancies[func_name][CodeData.NODE]) or '-'
+            code_dependancies.add(
+                func_name, 
+                {
+                    CodeData.CUSTOM: False,
+                    CodeData.DOC: doc_str,
+                    CodeData.DOC_SHORT: get_existing_short_docs(func_name, doc_str, llm_mode, args),
+                }
+            )
+            
+    logging.info(f'Found {len(changed_funcs)} changed functions/methods/classes: {", ".join(f"`{func}`" for func in changed_funcs)}')
+    
+    return changed_funcs
+
+
+def generate_documentation_for_func(func_name, code_dependancies, llm_mode, args, budget_check=None):
+    reason = None
+    used_tokens = TOK_COUNT.copy()
+    func_info = code_dependancies[func_name]
+    output_mode = get_output_mode(func_info[CodeData.NODE], args.output_mode)
+    prompt = DOC_PATCH_PROMPT if output_mode == PATCH else DOC_GENERATION_PROMPT
+    prompt_str = prompt(func_info[CodeData.CODE], get_reference_docs_custom_functions(func_name, code_dependancies))
+    
+    max_tokens = get_max_tokens(estimate_completion_tokens(func_info[CodeData.CODE], output_mode), args)
+    
+    for ri in range(args.max_retries):
+        # The first try is checked by the caller, retries must fit the budget even if they use all of max_tokens
+        if ri > 0 and budget_check and not budget_check(used_tokens + Counter(prompt_tokens=count_tokens(SYSTEM_PROMPT + prompt_str), completion_tokens=max_tokens)):
+            return False, ri, f'Budget exceeded after {ri} tries, last reason: {reason}', used_tokens
+        
+        logging.debug(f'\tTry {ri+1}/{args.max_retries} for `{func_name}`')
+        llm_out, used_toks = get_llm_output(
+            SYSTEM_PROMPT, 
+            prompt_str,
+            llm_mode,
+            args,
+            max_tokens,
+        )
+        used_tokens += used_toks
+        
+        if is_truncated(used_toks):
+            # Give the next try more room, truncated output does not parse or verify
+            logging.debug(f'\t\tOutput for `{func_name}` was truncated at {max_tokens} tokens')
+            max_tokens = min(2*max_tokens, args.max_tokens)
+        
+        if output_mode == PATCH:
+            patch, success, reason = parse_doc_patch(func_name, llm_out)
+            if not success:
+                continue
+            new_func_code, new_func_node, success, reason = apply_doc_patch(func_name, func_info[CodeData.CODE], func_info[CodeData.NODE], func_info[CodeData.CODE_INDENT], patch)
+            # The patched code keeps the original indentation, only the first line needs the indent
+            new_code_lines = [func_info[CodeData.CODE_INDENT] + new_func_code] if success else []
+        else:
+            new_func_code, new_func_node, success, reason = parse_commented_function(func_name, llm_out)
+            new_code_lines = [func_info[CodeData.CODE_INDENT] + line for line in new_func_code.split('\n')]
+        
+        if not success:
+            continue
+    
+        same, ast_reason = same_ast_with_reason(remove_docstring(func_info[CodeData.NODE]), remove_docstring(new_func_node))
+        if same:
+            code_dependancies.add(
+                func_name,
+                {
+                    CodeData.CODE_NEW: '\n'.join(new_code_lines),
+                    CodeData.DOC: ast.get_docstring(new_func_node),
+                }
+            )
+            return True, ri+1, reason, used_tokens
+        else:
+            # with open('debug.func.log', 'a') as f:
+            #     print(f'func: {func_name} | try: {ri}', file=f)
+            #     print(new_func_code, file=f)
+            #     print('-'*10, file=f)
+            #     print(func_info[CodeData.CODE], file=f)
+            #     print('-'*42, file=f)
+            reason = f'AST mismatch: {ast_reason}'
+            
+    return False, args.max_retries, reason, used_tokens
+
+
+def get_code_dump(func_name, code_dependancies):
+    # Copies of the same code only differ in their name, docstring, position and indentation
+    func_node = remove_docstring(code_dependancies[func_name][CodeData.NODE])
+    func_node.name = ''
+    return ast.dump(func_node)
+
+
+def get_dedup_key(func_name, code_dependancies, args):
+    ref_docs = get_reference_docs_custom_functions(func_name, code_dependancies)
+    return hashlib.sha256((get_code_dump(func_name, code_dependancies) + json.dumps(ref_docs) + args.output_mode).encode()).hexdigest()
 
+
+def reuse_documentation(func_name, source_func, code_dependancies):
+    func_info, source_info = code_dependancies[func_name], code_dependancies[source_func]
+    source_indent = source_info[CodeData.CODE_INDENT]
+    
+    new_func_code = '\n'.join(line[len(source_indent):] if line.startswith(source_indent) else line for line in source_info[CodeData.CODE_NEW].split('\n'))
+    new_func_code = rename_definition(new_func_code, source_func, func_name)
+    new_code_lines = [func_info[CodeData.CODE_INDENT] + line for line in new_func_code.split('\n')]
+    
+    try:
+        new_func_node = ast.parse(textwrap.dedent(new_func_code)).body[0]
+    except SyntaxError:
+        return False
+    
+    same, _ = same_ast_with_reason(remove_docstring(func_info[CodeData.NODE]), remove_docstring(new_func_node))
+    if same:
+        code_dependancies.add(
+            func_name,
+            {
+                CodeData.CODE_NEW: '\n'.join(new_code_lines),
+                CodeData.DOC: ast.get_docstring(new_func_node),
+            }
+        )
+    return same
+
+
+def load_shared_docs(func_name, code_dependancies, doc_store, args, wait=True):
+    # Returns the dependancies whose docs were not published by other shards (yet)
+    missing_deps = []
+    for dep_func in code_dependancies[func_name][CodeData.DEP]:
+        if code_dependancies[dep_func][CodeData.TRIAGE] != OTHER_SHARD or code_dependancies[dep_func][CodeData.DOC_SHORT] != '-':
+            continue
+        
+        wait_until = time.time() + (args.shard_wait if wait else 0)
+        while dep_func not in doc_store and time.time() < wait_until:
+            time.sleep(1)
+            
+        if dep_func in doc_store:
+            code_dependancies.add(dep_func, {CodeData.DOC_SHORT: doc_store.get(dep_func)})
+        else:
+            missing_deps.append(dep_func)
+            
+    return missing_deps
+
+
+def generate_documentation_deduplicated(func_name, code_dependancies, llm_mode, args, dedup_funcs, dedup_key=None, budget_check=None):
+    if args.no_dedup:
+        return generate_documentation_for_func(func_name, code_dependancies, llm_mode, args, budget_check)
+    
+    dedup_key = dedup_key or get_dedup_key(func_name, code_dependancies, args)
+    if dedup_key in dedup_funcs:
+        source_func, (success, _, reason, _) = dedup_funcs[dedup_key]
+        # Retries are shared, a copy of code that already failed is not retried
+        if not success:
+            return False, 0, f'Same code as `{source_func}`, {reason}', TOK_COUNT.copy()
+        if reuse_documentation(func_name, source_func, code_dependancies):
+            return True, 0, f'Reused docs of identical `{source_func}`', TOK_COUNT.copy()
+        
+    out = generate_documentation_for_func(func_name, code_dependancies, llm_mode, args, budget_check)
+    dedup_funcs.setdefault(dedup_key, (func_name, out))
+    return out
+
+
+def get_cost(tokens, args):
+    if not args.prices:
+        return 0
+    return (tokens['prompt_tokens'] * args.prices[0] + tokens['completion_tokens'] * args.prices[1]) / 1e6
+
+
+def within_budget(tokens, args):
+    if args.token_budget and tokens['prompt_tokens'] + tokens['completion_tokens'] > args.token_budget:
+        return False
+    if args.cost_budget and get_cost(tokens, args) > args.cost_budget:
+        return False
+    return True
+
+
+def get_prioritized_funcs(code_dependancies, custom_funcs, args, spent_tokens):
+    fan_in = Counter(dep for func_name in custom_funcs for dep in set(code_dependancies[func_name][CodeData.DEP]) if dep != func_name)
+    is_public = lambda x: not x.startswith('_') or (x.startswith('__') and x.endswith('__'))
+    ranked_funcs = sorted(custom_funcs, key=lambda x: (is_public(x), fan_in[x], len(code_dependancies[x][CodeData.CODE])), reverse=True)
+    
+    estimates = {}
+    selected_funcs = []
+    selected_code = set()
+    total_estimate = TOK_COUNT.copy()
+    for func_name in ranked_funcs:
+        prompt_tokens, completion_tokens = estimate_tokens(code_dependancies, func_name, args.output_mode)
+        # The token limit of the call is reserved, the completion can use all of it
+        estimates[func_name] = Counter(prompt_tokens=prompt_tokens, completion_tokens=get_max_tokens(completion_tokens, args))
+        
+        # Copies of selected code are expected to reuse its docs for free
+        code_dump = None if args.no_dedup else get_code_dump(func_name, code_dependancies)
+        estimate = TOK_COUNT.copy() if code_dump in selected_code else estimates[func_name]
+        if not within_budget(spent_tokens + total_estimate + estimate, args):
+            break
+        total_estimate += estimate
+        selected_funcs.append(func_name)
+        selected_code.add(code_dump)
+        
+    logging.info(f'Budget allows for an estimated {len(selected_funcs)}/{len(custom_funcs)} custom functions/methods/classes (prompt_tokens: {total_estimate["prompt_tokens"]}, completion_tokens: {total_estimate["completion_tokens"]}' + (f', cost: {get_cost(total_estimate, args):.4f})' if args.prices else ')'))
+    
+    return selected_funcs, {func_name: i for i, func_name in enumerate(ranked_funcs)}, estimates
+
+
+def log_token_usage(total_tokens, args):
+    logging.info(f'Tokens used: ' + ', '.join(f'{k}: {v}' for k,v in total_tokens.items()))
+    if args.prices:
+        logging.info(f'Cost: {get_cost(total_tokens, args):.4f}')
+
+
+def get_existing_short_docs(func_name, doc_str, llm_mode, args):
+    # Existing docstrings are used without extra LLM calls, summarizing falls back to truncation
+    mode = 'truncate' if args.ref_doc == 'summarize' else args.ref_doc
+    return get_shortened_docs(func_name, doc_str, mode, llm_mode, args)
+
+
+def triage_custom_funcs(code_dependancies, llm_mode, args):
+    if args.triage == 'none':
+        return
+    
+    counts = Counter()
+    for func_name, func_info in code_dependancies.items():
+        if not func_info[CodeData.CUSTOM] or func_info[CodeData.TRIAGE] != '-':
+            continue
+        
+        doc_str = ast.get_docstring(func_info[CodeData.NODE])
+        if doc_str:
+            triage = DOCUMENTED
+            code_dependancies.add(func_name, {CodeData.DOC: doc_str})
+            
+        elif args.triage == 'all' and is_trivial(func_info[CodeData.NODE]):
+            triage = TRIVIAL
+            doc_str = get_template_docstring(func_info[CodeData.NODE])
+            if args.trivial == 'template':
+                new_func_code, new_func_node, success, _ = apply_doc_patch(func_name, func_info[CodeData.CODE], func_info[CodeData.NODE], func_info[CodeData.CODE_INDENT], {'docstring': doc_str, 'comments': []})
+                if success:
+                    code_dependancies.add(
+                        func_name,
+                        {
+                            CodeData.CODE_NEW: func_info[CodeData.CODE_INDENT] + new_func_code,
+                            CodeData.DOC: ast.get_docstring(new_func_node),
+                        }
+                    )
+                else:
+                    triage = NEEDS_LLM
+                    
+        else:
+            triage = NEEDS_LLM
+            
+        code_dependancies.add(func_name, {CodeData.TRIAGE: triage})
+        if triage != NEEDS_LLM:
+            # Dependants reference the existing or template docstring directly
+            code_dependancies.add(func_name, {CodeData.DOC_SHORT: get_existing_short_docs(func_name, doc_str, llm_mode, args)})
+        counts[triage] += 1
+        
+    logging.info(f'Triage: ' + ', '.join(f'{k}: {counts[k]}' for k in [DOCUMENTED, TRIVIAL, NEEDS_LLM]))
+
+
+def generate_documentation_for_custom_calls(code_dependancies, llm_mode, args, doc_store=None, spent_tokens=None):
+    # Tokens spent earlier in the same run (e.g. previous partitions) count against the budget
+    spent_tokens = spent_tokens or TOK_COUNT.copy()
+    triage_custom_funcs(code_dependancies, llm_mode, args)
+    
+    if doc_store:
+        # Triaged code never reaches the LLM, other shards can reference its docs right away
+        doc_store.update({func_name: func_info[CodeData.DOC_SHORT] for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.TRIAGE] in (DOCUMENTED, TRIVIAL)})
+    
+    if args.workers > 1:
+        total_tokens = generate_documentation_for_custom_calls_concurrently(code_dependancies, llm_mode, args, doc_store, spent_tokens)
+    else:
+        total_tokens = generate_documentation_for_custom_calls_sequentially(code_dependancies, llm_mode, args, doc_store, spent_tokens)
+        
+    if doc_store:
+        # Code left undocumented (e.g. over budget) is published without docs, so other shards stop waiting for it
+        doc_store.update({func_name: func_info[CodeData.DOC_SHORT] for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_name not in doc_store})
+        
+    return total_tokens
+    
+    
+def generate_documentation_for_custom_calls_sequentially(code_dependancies, llm_mode, args, doc_store=None, spent_tokens=None):
+    spent_tokens = spent_tokens or TOK_COUNT.copy()
+    custom_funcs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.TRIAGE] not in (DOCUMENTED, TRIVIAL)]
+    
+    budget = args.token_budget or args.cost_budget
+    if budget:
+        custom_funcs, priority, estimates = get_prioritized_funcs(code_dependancies, custom_funcs, args, spent_tokens)
+        
+    if not custom_funcs:
+        logging.info('No custom functions/methods/classes to document')
+        return TOK_COUNT.copy()
+        
     num_custom_funcs = len(custom_funcs)
     num_digits = math.ceil(math.log(num_custom_funcs, 10))
     logging.info(f'Generating docs for {len(custom_funcs)} custom functions/methods/classes')
 
     total_tokens = TOK_COUNT.copy()
+    dedup_funcs = {}
 
     for i in range(num_custom_funcs):
-        least_dep_func = min(custom_funcs, key=lambda x: code_dependancies.undocumented_dependancies(x))
-        reason = None
-        
-        for ri in range(args.max_retries):
-            logging.debug(f'\tTry {ri+1}/{args.max_retries} for `{least_dep_func}`')
-            llm_out, used_toks = get_llm_output(
-                SYSTEM_PROMPT, 
-                DOC_GENERATION_PROMPT(
-                    code_dependancies[least_dep_func][CodeData.CODE], 
-                    get_reference_docs_custom_functions(least_dep_func, code_dependancies)
-                ),
-                llm_mode,
-                args,
-            )
-            total_tokens += used_toks
+        if budget:
+            least_dep_func = min(custom_funcs, key=lambda x: (code_dependancies.undocumented_dependancies(x), priority[x]))
+        else:
+            least_dep_func = min(custom_funcs, key=lambda x: code_dependancies.undocumented_dependancies(x))
+        
+        if doc_store:
+            for dep_func in load_shared_docs(least_dep_func, code_dependancies, doc_store, args):
+                logging.debug(f'\t\tNo documentation from other shards for `{dep_func}`')
             
-            new_func_code, new_func_node, success, reason = parse_commented_function(least_dep_func, llm_out)
+        # Copies of already documented code cost no tokens and are not checked against the budget
+        dedup_key = None if args.no_dedup else get_dedup_key(least_dep_func, code_dependancies, args)
+        if budget and dedup_key not in dedup_funcs and not within_budget(spent_tokens + total_tokens + estimates[least_dep_func], args):
+            logging.info(f'Stopping, documenting `{least_dep_func}` would exceed the budget ({len(custom_funcs)} functions/methods/classes left)')
+            break
             
-            if not success:
-                continue
+        budget_check = (lambda tokens: within_budget(spent_tokens + total_tokens + tokens, args)) if budget else None
+        success, tries, reason, used_toks = generate_documentation_deduplicated(least_dep_func, code_dependancies, llm_mode, args, dedup_funcs, dedup_key, budget_check)
+        total_tokens += used_toks
         
-            same, ast_reason = same_ast_with_reason(remove_docstring(code_dependancies[least_dep_func][CodeData.NODE]), remove_docstring(new_func_node))
-            if same:
-                code_dependancies.add(
-                    least_dep_func,
-                    {
-                        CodeData.CODE_NEW: '\n'.join([code_dependancies[least_dep_func][CodeData.CODE_INDENT] + line for line in new_func_code.split('\n')]),
-                        CodeData.DOC: ast.get_docstring(new_func_node),
-                    }
-                )
-                logging.info(f'\t[{str(i+1).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] Generated docs for `{least_dep_func}` in {ri+1}/{args.max_retries} tries')      
-                break
-            else:
-                # with open('debug.func.log', 'a') as f:
-                #     print(f'func: {least_dep_func} | try: {ri}', file=f)
-                #     print(new_func_code, file=f)
-                #     print('-'*10, file=f)
-                #     print(code_dependancies[least_dep_func][CodeData.CODE], file=f)
-                #     print('-'*42, file=f)
-                reason = f'AST mismatch: {ast_reason}'
+        if success and tries == 0:
+            logging.info(f'\t[{str(i+1).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] {reason} for `{least_dep_func}`')
+        elif success:
+            logging.info(f'\t[{str(i+1).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] Generated docs for `{least_dep_func}` in {tries}/{args.max_retries} tries')      
         else:
-            logging.info(f'\t[{str(i+1).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] Could not generate docs for `{least_dep_func}` after {args.max_retries} tries')
+            logging.info(f'\t[{str(i+1).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] Could not generate docs for `{least_dep_func}` after {tries} tries')
             logging.info(f'\t\tReason: {reason}')
         
         if code_dependancies[least_dep_func][CodeData.DOC] != '-':
             code_dependancies.add(
                 least_dep_func, 
-                {CodeData.DOC_SHORT: get_shortened_docs(least_dep_func, CodeData.DOC, args.ref_doc, llm_mode, args)}
+                {CodeData.DOC_SHORT: get_shortened_docs(least_dep_func, code_dependancies[least_dep_func][CodeData.DOC], args.ref_doc, llm_mode, args, total_tokens)}
             )            
+        if doc_store:
+            # Failures are published as '-' so other shards stop waiting for them
+            doc_store.put(least_dep_func, code_dependancies[least_dep_func][CodeData.DOC_SHORT])
 
         custom_funcs.remove(least_dep_func)
         
-    custom_funcs_with_docs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.DOC] != '-']
+    custom_funcs_with_docs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.TRIAGE] not in (DOCUMENTED, TRIVIAL) and func_info[CodeData.DOC] != '-']
     logging.info(f'Generated docs for {len(custom_funcs_with_docs)}/{num_custom_funcs} custom functions/classes.methods')
-    logging.info(f'Tokens used: ' + ', '.join(f'{k}: {v}' for k,v in total_tokens.items()))
+    log_token_usage(total_tokens, args)
     
+    return total_tokens
     
-def replace_modified_functions(code_dependancies, path):
-    custom_funcs_with_docs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.DOC] != '-']
     
-    if os.path.isdir(path):
-        for root, _, files in os.walk(path):
-            for file in files:
-                if os.path.splitext(file)[-1] == '.py':
-                    path = os.path.join(root, file)
-                    logging.info(f'Replacing functions in {path}')
+def generate_documentation_for_custom_calls_concurrently(code_dependancies, llm_mode, args, doc_store=None, spent_tokens=None):
+    spent_tokens = spent_tokens or TOK_COUNT.copy()
+    custom_funcs = set(func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.TRIAGE] not in (DOCUMENTED, TRIVIAL))
+    
+    budget = args.token_budget or args.cost_budget
+    if budget:
+        selected_funcs, priority, estimates = get_prioritized_funcs(code_dependancies, custom_funcs, args, spent_tokens)
+        custom_funcs = set(selected_funcs)
+        
+    if not custom_funcs:
+        logging.info('No custom functions/methods/classes to document')
+        return TOK_COUNT.copy()
+
+    num_custom_funcs = len(custom_funcs)
+    num_digits = math.ceil(math.log(num_custom_funcs, 10))
+    logging.info(f'Generating docs for {len(custom_funcs)} custom functions/methods/classes using {args.workers} workers')
+
+    total_tokens = TOK_COUNT.copy()
+    
+    dedup_funcs = {}
+    
+    # Running functions reserve the tokens of their next try, so concurrent retries cannot overshoot the budget together
+    budget_lock = threading.Lock()
+    reserved = {}
+    
+    def reserve(func_name, tokens):
+        with budget_lock:
+            reserved_others = sum((v for k,v in reserved.items() if k != func_name), TOK_COUNT.copy())
+            if not within_budget(spent_tokens + total_tokens + reserved_others + tokens, args):
+                return False
+            reserved[func_name] = tokens
+            return True
+    
+    def document_func(func_name, dedup_key):
+        budget_check = (lambda tokens: reserve(func_name, tokens)) if budget else None
+        success, tries, reason, used_toks = generate_documentation_deduplicated(func_name, code_dependancies, llm_mode, args, dedup_funcs, dedup_key, budget_check)
+        if code_dependancies[func_name][CodeData.DOC] != '-':
+            # Summarizing the new docs is part of the tokens used for the function
+            code_dependancies.add(
+                func_name, 
+                {CodeData.DOC_SHORT: get_shortened_docs(func_name, code_dependancies[func_name][CodeData.DOC], args.ref_doc, llm_mode, args, used_toks)}
+            )
+        if doc_store:
+            # Failures are published as '-' so other shards stop waiting for them
+            doc_store.put(func_name, code_dependancies[func_name][CodeData.DOC_SHORT])
+        return success, tries, reason, used_toks
+    
+    pending_deps = lambda func_name: [dep for dep in code_dependancies[func_name][CodeData.DEP] if dep != func_name and dep in custom_funcs]
+    
+    i = 0
+    running = {}
+    running_keys = {}
+    shared_wait_until = {}
+    stopped = False
+    with ThreadPoolExecutor(args.workers) as executor:
+        while (custom_funcs and not stopped) or running:
+            # Only start functions whose custom dependancies are documented, so their docs can be referenced
+            waiting = sorted(custom_funcs - set(running.values()), key=lambda x: priority[x] if budget else x)
+            ready = [func_name for func_name in waiting if not pending_deps(func_name)]
+            if not ready and not running:
+                # Dependancy cycle, break it at the function with the fewest pending dependancies
+                ready = [min(waiting, key=lambda x: len(pending_deps(x)))]
+                
+            deferred = False
+            for func_name in ([] if stopped else ready):
+                if len(running) >= args.workers:
+                    break
                     
-                    with open(path) as f:    
-                        file_str = f.read()
-                        
-                    changed = False
-                    path_funcs = sorted(
-                        [func for func in custom_funcs_with_docs if code_dependancies[func][CodeData.PATH] == path]
-                        , key = lambda x: 1 if code_dependancies[func][CodeData.TYPE] == 'class' else 0
+                if doc_store:
+                    # Functions waiting for docs of other shards are skipped for now, the scheduler never blocks on the store
+                    missing_deps = load_shared_docs(func_name, code_dependancies, doc_store, args, wait=False)
+                    if missing_deps and time.time() < shared_wait_until.setdefault(func_name, time.time() + args.shard_wait):
+                        deferred = True
+                        continue
+                    for dep_func in missing_deps:
+                        logging.debug(f'\t\tNo documentation from other shards for `{dep_func}`')
+                    
+                # Copies of code which is already being documented wait for its result
+                dedup_key = None if args.no_dedup else get_dedup_key(func_name, code_dependancies, args)
+                if dedup_key and dedup_key in running_keys.values():
+                    continue
+                if budget and dedup_key not in dedup_funcs and not reserve(func_name, estimates[func_name]):
+                    logging.info(f'Stopping, documenting `{func_name}` would exceed the budget ({len(waiting)} functions/methods/classes left)')
+                    stopped = True
+                    break
+                future = executor.submit(document_func, func_name, dedup_key)
+                running[future] = func_name
+                running_keys[future] = dedup_key
+                
+            if not running and deferred:
+                time.sleep(1)
+                continue
+            if not running:
+                break
+                
+            done, _ = wait(running, timeout=1 if deferred else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                func_name = running.pop(future)
+                running_keys.pop(future)
+                custom_funcs.discard(func_name)
+                success, tries, reason, used_toks = future.result()
+                with budget_lock:
+                    total_tokens += used_toks
+                    reserved.pop(func_name, None)
+                i += 1
+                
+                if success and tries == 0:
+                    logging.info(f'\t[{str(i).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] {reason} for `{func_name}`')
+                elif success:
+                    logging.info(f'\t[{str(i).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] Generated docs for `{func_name}` in {tries}/{args.max_retries} tries')      
+                else:
+                    logging.info(f'\t[{str(i).zfill(num_digits)}/{str(num_custom_funcs).zfill(num_digits)}] Could not generate docs for `{func_name}` after {tries} tries')
+                    logging.info(f'\t\tReason: {reason}')
+                    
+    custom_funcs_with_docs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.TRIAGE] not in (DOCUMENTED, TRIVIAL) and func_info[CodeData.DOC] != '-']
+    logging.info(f'Generated docs for {len(custom_funcs_with_docs)}/{num_custom_funcs} custom functions/classes.methods')
+    log_token_usage(total_tokens, args)
+    
+    return total_tokens
+    
+    
+def replace_modified_functions_in_file(code_dependancies, custom_funcs_with_docs, path):
+    logging.info(f'Replacing functions in {path}')
+    
+    with open(path) as f:    
+        file_str = f.read()
+        
+    changed = False
+    path_funcs = sorted(
+        [func for func in custom_funcs_with_docs if code_dependancies[func][CodeData.PATH] == path]
+        , key = lambda x: 1 if code_dependancies[x][CodeData.TYPE] == 'class' else 0
+    )
+    for func in path_funcs:
+        changed = True
+        file_str = replace_func(
+                        func, 
+                        code_dependancies[func][CodeData.CODE], 
+                        code_dependancies[func][CodeData.CODE_NEW], 
+                        path,
+                        file_str
                     )
-                    for func in path_funcs:
-                        if code_dependancies[func][CodeData.PATH] == path:
-                            changed = True
-                            file_str = replace_func(
-                                            func, 
-                                            code_dependancies[func][CodeData.CODE], 
-                                            code_dependancies[func][CodeData.CODE_NEW], 
-                                            path,
-                                            file_str
-                                        )
-                            
-                    if changed:
-                        with open(path, 'w') as f:
-                            f.write(file_str)
+            
+    if changed:
+        with open(path, 'w') as f:
+            f.write(file_str)
+
+
+def replace_modified_functions(code_dependancies, path, files=None):
+    custom_funcs_with_docs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM] and func_info[CodeData.DOC] != '-' and func_info[CodeData.CODE_NEW] != '-']
+    
+    if files is not None:
+        for path in files:
+            replace_modified_functions_in_file(code_dependancies, custom_funcs_with_docs, path)
+    
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                if os.path.splitext(file)[-1] == '.py':
+                    replace_modified_functions_in_file(code_dependancies, custom_funcs_with_docs, os.path.join(root, file))
                     
     elif os.path.splitext(path)[-1] == '.py':
+        replace_modified_functions_in_file(code_dependancies, custom_funcs_with_docs, path)
         
-        logging.info(f'Replacing functions in {path}')
+    else:
+        raise Exception(f'Could not parse path: `{path}`')
+
+
+def document_in_partitions(path, llm_mode, args):
+    partitions = get_partitions(get_symbol_index(path), args.partition_size)
+    logging.info(f'Split project into {len(partitions)} partitions of at most {args.partition_size} files')
+    
+    report_path = f'doc_report_{path.split("/")[-1]}.csv'
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    
+    # The store only lives as long as the run unless --spill_dir is given
+    tmp_dir = None if args.spill_dir else tempfile.TemporaryDirectory(prefix='lmdocs_')
+    spill_dir = args.spill_dir or tmp_dir.name
+    os.makedirs(spill_dir, exist_ok=True)
+    doc_store = DocStore(os.path.join(spill_dir, 'doc_store.sqlite'))
+    logging.info(f'Using reference documentation store: {doc_store.path}')
+    
+    total_tokens = TOK_COUNT.copy()
+    try:
+        for pi, files in enumerate(partitions):
+            logging.info(f'Partition {pi+1}/{len(partitions)}: {len(files)} files')
         
-        with open(path) as f:    
-            file_str = f.read()
-        
-        changed = False
-        for func in custom_funcs_with_docs:
-            if code_dependancies[func][CodeData.PATH] == path:
-                changed = True
-                file_str = replace_func(
-                                func, 
-                                code_dependancies[func][CodeData.CODE], 
-                                code_dependancies[func][CodeData.CODE_NEW], 
-                                path,
-                                file_str
-                            )
+            code_dependancies, import_stmts = get_code_dependancies_and_imports(path, files=files)
+            custom_funcs = [func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM]]
+            if not custom_funcs:
+                continue
+        
+            # Docs from earlier partitions are loaded from the store instead of being recomputed
+            simple_funcs = []
+            for func_name, func_info in code_dependancies.items():
+                if func_info[CodeData.CUSTOM]:
+                    continue
+                if func_name in doc_store:
+                    code_dependancies.add(func_name, {CodeData.DOC_SHORT: doc_store.get(func_name)})
+                elif code_dependancies.dependancies(func_name) == 0:
+                    simple_funcs.append(func_name)
                 
-        if changed:
-            with open(path, 'w') as f:
-                f.write(file_str)
+            total_tokens += add_reference_docs(code_dependancies, import_stmts, simple_funcs, llm_mode, args)
+            doc_store.update({func_name: code_dependancies[func_name][CodeData.DOC_SHORT] for func_name in simple_funcs})
         
-    else:
-        raise Exception(f'Could not parse path: `{path}`')
\ No newline at end of file
+            total_tokens += generate_documentation_for_custom_calls(code_dependancies, llm_mode, args, spent_tokens=total_tokens)
+            doc_store.update({func_name: code_dependancies[func_name][CodeData.DOC_SHORT] for func_name in custom_funcs})
+
+            replace_modified_functions(code_dependancies, path, files=files)
+            generate_report(code_dependancies, report_path, append=True)
+        
+            del code_dependancies, import_stmts
+    finally:
+        doc_store.close()
+        if tmp_dir:
+            tmp_dir.cleanup()
+            
+    logging.info(f'Saved Documentation report in ./{report_path}')
+    logging.info('Token usage over all partitions')
+    log_token_usage(total_tokens, args)
+
+
+def document_shard(path, llm_mode, args):
+    shard_index, num_shards = args.shard
+    
+    code_dependancies, import_stmts = get_code_dependancies_and_imports(path)
+    shard_funcs = set(get_shards(code_dependancies, num_shards, get_symbol_weights(path))[shard_index-1])
+    num_custom_funcs = len([func_name for func_name, func_info in code_dependancies.items() if func_info[CodeData.CUSTOM]])
+    logging.info(f'Shard {shard_index}/{num_shards}: {len(shard_funcs)}/{num_custom_funcs} custom functions/methods/classes')
+    
+    # Code of other shards is only used as reference, existing docstrings are read locally,
+    # the other docs come from the shared doc store
+    for func_name, func_info in code_dependancies.items():
+        if func_info[CodeData.CUSTOM] and func_name not in shard_funcs:
+            doc_str = ast.get_docstring(func_info[CodeData.NODE]) or '-'
+            code_dependancies.add(func_name, {CodeData.CUSTOM: False, CodeData.TRIAGE: OTHER_SHARD, CodeData.DOC_SHORT: get_existing_short_docs(func_name, doc_str, llm_mode, args)})
+            
+    simple_funcs = [func_name for func_name, func_info in code_dependancies.items() if code_dependancies.dependancies(func_name) == 0 and func_info[CodeData.TRIAGE] != OTHER_SHARD]
+    total_tokens = add_reference_docs(code_dependancies, import_stmts, simple_funcs, llm_mode, args)
+    
+    doc_store = SharedDocStore(args.doc_store) if args.doc_store else None
+    total_tokens += generate_documentation_for_custom_calls(code_dependancies, llm_mode, args, doc_store, spent_tokens=total_tokens)
+    
+    fields = [CodeData.PATH, CodeData.TYPE, CodeData.TRIAGE, CodeData.DOC, CodeData.DOC_SHORT, CodeData.CODE, CodeData.CODE_NEW, CodeData.CODE_INDENT]
+    results = {
+        'shard': shard_index,
+        'num_shards': num_shards,
+        'tokens': dict(total_tokens),
+        'symbols': {func_name: {k: code_dependancies[func_name][k] for k in fields} for func_name in sorted(shard_funcs)},
+    }
+    
+    shard_output = args.shard_output or f'lmdocs_shard_{shard_index}_of_{num_shards}.json'
+    with open(shard_output, 'w') as f:
+        json.dump(results, f)
+    logging.info(f'Saved shard results in {shard_output}')
+    
+
+def merge_shard_results(path, result_paths, args):
+    code_dependancies = CodeData()
+    total_tokens = TOK_COUNT.copy()
+    shards = set()
+    num_shards = None
+    
+    for result_path in result_paths:
+        with open(result_path) as f:
+            results = json.load(f)
+            
+        if num_shards is not None and results['num_shards'] != num_shards:
+            raise Exception(f'`{result_path}` is a result of {results["num_shards"]} shards, expected {num_shards}')
+        num_shards = results['num_shards']
+        shards.add(results['shard'])
+        total_tokens += Counter(results['tokens'])
+        
+        for func_name, func_info in results['symbols'].items():
+            code_dependancies.add(func_name, {**func_info, CodeData.CUSTOM: True})
+            
+    missing_shards = sorted(set(range(1, num_shards+1)) - shards)
+    if missing_shards:
+        logging.warning(f'Missing results for shards: {missing_shards}')
+        
+    replace_modified_functions(code_dependancies, path)
+    
+    report_path = f'doc_report_{path.split("/")[-1]}.csv'
+    generate_report(code_dependancies, report_path)
+    logging.info(f'Saved Documentation report in ./{report_path}')
+    log_token_usage(total_tokens, args)